@@ -0,0 +1,174 @@
+# annotate.py
+import hashlib
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import typer
+from loguru import logger
+from ultralytics.utils.plotting import Annotator, Colors
+
+from models import LabelBox, TextRect
+from metrics import timer
+
+# DocLayNet classes in the order of data.yaml, so every label keeps the color it has in test.py
+LABELS = (
+    "Caption", "Footnote", "Formula", "List-item", "Page-footer", "Page-header",
+    "Picture", "Section-header", "Table", "Text", "Title",
+)
+LAYERS = ("detect", "compare", "reclassify")
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff"}
+
+# Compare layer colors (BGR) of the text rects inside and outside the layout
+INSIDE_COLOR = (0, 0, 255)
+OUTSIDE_COLOR = (255, 0, 0)
+
+colors = Colors()
+
+def label_color(label: str) -> Tuple[int, int, int]:
+    index = LABELS.index(label) if label in LABELS else len(LABELS) + sum(map(ord, label))
+    return colors(index, bgr=True)
+
+def draw_label_boxes(image: np.ndarray, label_boxes: List[LabelBox], scale: float = 1.0, line_width: int = 2, font_size: int = 8, color: Optional[Tuple[int, int, int]] = None) -> np.ndarray:
+    """Draw labelled layout rects onto a BGR image, with boxes given at 1 / scale of its resolution, in color or each label's color."""
+    annotator = Annotator(image, line_width=line_width, font_size=font_size)
+    for label_box in label_boxes:
+        box_color = color or label_color(label_box.label)
+        annotator.box_label([v * scale for v in label_box.box], label_box.label, color=box_color, txt_color=box_color if color else (255, 255, 255))
+    return annotator.result()
+
+def draw_text_rects(image: np.ndarray, inside: List[TextRect], outside: List[TextRect], scale: float = 1.0) -> np.ndarray:
+    """Outline every text rect, in red inside the layout and in blue outside it, opaque on a BGRA image."""
+    for text_rects, color in ((inside, INSIDE_COLOR), (outside, OUTSIDE_COLOR)):
+        if image.shape[2] == 4:
+            color = (*color, 255)
+        for rect in text_rects:
+            x0, y0, x1, y1 = (round(v * scale) for v in rect.box)
+            cv2.rectangle(image, (x0, y0), (x1, y1), color, 1)
+    return image
+
+def layer_digest(layer: str, *groups: list) -> str:
+    """Hash the rects drawn on a layer, so an overlay is only rendered again when they change."""
+    digest = hashlib.md5(layer.encode("utf-8"))
+    for items in groups:
+        digest.update(b"|")
+        for item in items:
+            digest.update(repr((getattr(item, "label", None), tuple(item.box))).encode("utf-8"))
+    return digest.hexdigest()
+
+class OverlayCache:
+    """
+    Overlay PNGs on disk keyed by (file_id, page_number, layer).
+
+    Each entry remembers the digest of the rects it was drawn from, so unchanged layers are
+    served from disk and the digest doubles as the ETag of the PNG.
+    """
+
+    def __init__(self, directory: Callable[[str], Path]):
+        # Returns the overlay directory of a document
+        self.directory = directory
+        self.digests: Dict[Tuple[str, int, str], str] = {}
+        self.lock = threading.Lock()
+
+    def path(self, file_id: str, page_number: int, layer: str) -> Path:
+        return self.directory(file_id) / f"{file_id}_page_{page_number}_{layer}.png"
+
+    def get(self, file_id: str, page_number: int, layer: str, digest: str) -> Optional[Path]:
+        path = self.path(file_id, page_number, layer)
+        with self.lock:
+            if self.digests.get((file_id, page_number, layer)) == digest and path.exists():
+                return path
+        return None
+
+    def put(self, file_id: str, page_number: int, layer: str, digest: str, overlay: np.ndarray) -> Path:
+        path = self.path(file_id, page_number, layer)
+        ok, buffer = cv2.imencode(".png", overlay)
+        if not ok:
+            raise ValueError(f"Failed to encode {path}")
+        # Write aside and rename, so a concurrent reader never sees a partial PNG
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(buffer.tobytes())
+        tmp_path.replace(path)
+        with self.lock:
+            self.digests[(file_id, page_number, layer)] = digest
+        return path
+
+    def discard(self, file_id: str):
+        """Forget the overlays of a document, whose files are deleted along with its directory."""
+        with self.lock:
+            for key in [key for key in self.digests if key[0] == file_id]:
+                del self.digests[key]
+
+def render_overlay(size: Tuple[int, int], scale: float, layer: str, label_boxes: List[LabelBox] = None, inside: List[TextRect] = None, outside: List[TextRect] = None) -> np.ndarray:
+    """
+    Render one layer of a page as a transparent BGRA image.
+
+    Args:
+        size: Width and height of the overlay in pixels.
+        scale: Scale of the overlay relative to the full page resolution of the rects.
+        layer: One of LAYERS.
+        label_boxes: Layout rects, for the "detect" and "reclassify" layers.
+        inside: Text rects inside the layout, for the "compare" layer.
+        outside: Text rects outside the layout, for the "compare" layer.
+
+    Returns:
+        The overlay as a BGRA array.
+    """
+    canvas = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+    with timer("annotate_render"):
+        if layer == "compare":
+            draw_text_rects(canvas, inside or [], outside or [], scale)
+        else:
+            # Annotator only draws on BGR images, so the alpha channel is drawn as a second pass
+            # in white, covering boxes and label backgrounds whatever the colors of the first pass
+            canvas[..., :3] = draw_label_boxes(np.zeros((size[1], size[0], 3), dtype=np.uint8), label_boxes or [], scale)
+            canvas[..., 3] = draw_label_boxes(np.zeros((size[1], size[0], 3), dtype=np.uint8), label_boxes or [], scale, color=(255, 255, 255))[..., 0]
+    return canvas
+
+def main(
+    model: str,
+    source: Path,
+    output: Optional[Path] = None,
+    batch: int = 16,
+    line_width: int = 2,
+    font_size: int = 8,
+):
+    """Annotate every image in source (a file or directory) with a single model load."""
+    from ultralytics import YOLO
+
+    if source.is_file():
+        paths = [source]
+    else:
+        # Skip the output of earlier runs written next to their sources
+        paths = sorted(p for p in source.rglob("*") if p.suffix.lower() in IMAGE_SUFFIXES and not p.name.startswith("annotated-"))
+    output = output or (source.parent if source.is_file() else source)
+    yolo = YOLO(model)
+
+    for start in range(0, len(paths), batch):
+        chunk, images = [], []
+        for path in paths[start:start + batch]:
+            image = cv2.imread(str(path), cv2.IMREAD_COLOR)
+            if image is None:
+                logger.warning(f"Skipping unreadable image {path}")
+                continue
+            chunk.append(path)
+            images.append(image)
+        if not images:
+            continue
+        for path, result in zip(chunk, yolo.predict(images, verbose=False)):
+            height, width = result.orig_shape
+            label_boxes = [
+                LabelBox(label=result.names[int(cls)], box=[box[0] * width, box[1] * height, box[2] * width, box[3] * height], confidence=score)
+                for cls, box, score in zip(result.boxes.cls.tolist(), result.boxes.xyxyn.tolist(), result.boxes.conf.tolist())
+            ]
+            annotated = draw_label_boxes(result.orig_img.copy(), label_boxes, line_width=line_width, font_size=font_size)
+
+            target = output / path.relative_to(source).parent if source.is_dir() else output
+            target.mkdir(parents=True, exist_ok=True)
+            cv2.imwrite(str(target / f"annotated-{path.name}"), annotated)
+        logger.info(f"Annotated {min(start + batch, len(paths))} of {len(paths)} images.")
+
+if __name__ == "__main__":
+    typer.run(main)
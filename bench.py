@@ -0,0 +1,318 @@
+import io
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, List, Optional, Tuple
+
+import typer
+
+app = typer.Typer()
+
+LOREM = (
+    "Document layout analysis splits a page into regions such as titles, paragraphs, tables and figures. "
+    "Each region is then handled by the parser best suited to it."
+).split()
+
+
+def synthetic_pdf(pages: int, lines: int = 40) -> bytes:
+    """Build a text-only multi-page PDF with a title, paragraphs, a running header and a page number."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(1, pages + 1):
+        commands = ["BT /F1 9 Tf 72 760 Td (Synthetic benchmark report) Tj ET"]
+        commands.append(f"BT /F1 18 Tf 72 720 Td (Section {page}) Tj ET")
+        for line in range(lines):
+            words = " ".join(LOREM[(line + page + i) % len(LOREM)] for i in range(12))
+            commands.append(f"BT /F1 10 Tf 72 {696 - line * 15} Td ({words}) Tj ET")
+        commands.append(f"BT /F1 9 Tf 300 40 Td ({page}) Tj ET")
+        stream = "\n".join(commands)
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>"
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1"))
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode())
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
+
+
+def process_rss_mb(pid: int) -> Optional[float]:
+    """Resident set size of a process now, from /proc or psutil when available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        return psutil.Process(pid).memory_info().rss / 1024 ** 2
+    except psutil.Error:
+        return None
+
+
+class RssSampler:
+    """Sample the RSS of this process on a background thread while a stage runs."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.start_mb = None
+        self.peak_mb = None
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        rss = process_rss_mb(os.getpid())
+        if rss is not None:
+            self.peak_mb = max(self.peak_mb or rss, rss)
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.start_mb = process_rss_mb(os.getpid())
+        self.peak_mb = self.start_mb
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.sample()
+
+
+def measure(fn: Callable, repeat: int) -> Tuple[List[float], RssSampler]:
+    timings = []
+    with RssSampler() as rss:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+    return timings, rss
+
+
+def summarize(stage: str, measured: Tuple[List[float], RssSampler], pages_per_call: int, **config) -> dict:
+    timings, rss = measured
+    timings = sorted(timings)
+    p95_index = min(len(timings) - 1, round(0.95 * (len(timings) - 1)))
+    record = {
+        "stage": stage,
+        **config,
+        "p50_ms": statistics.median(timings) * 1000,
+        "p95_ms": timings[p95_index] * 1000,
+        "pages_per_sec": pages_per_call * len(timings) / sum(timings),
+        # Peak RSS while the stage ran and how far above its starting RSS that peak went
+        "peak_rss_mb": rss.peak_mb,
+        "rss_delta_mb": rss.peak_mb - rss.start_mb if rss.peak_mb is not None else None,
+    }
+    print(
+        f"{stage:<12} {json.dumps(config):<60} p50 {record['p50_ms']:8.1f}ms  p95 {record['p95_ms']:8.1f}ms  "
+        f"{record['pages_per_sec']:7.2f} pages/s  rss {record['peak_rss_mb'] or 0:.0f}MB (+{record['rss_delta_mb'] or 0:.0f}MB)"
+    )
+    return record
+
+
+def plot(records: List[dict], output: Path):
+    import matplotlib.pyplot as plt
+
+    labels = [f"{r['stage']}\n{r['model']} b{r['batch']} t{r['threads']} {r['dpi']}dpi" for r in records]
+    fig, ax = plt.subplots(figsize=(max(8, len(records) * 0.6), 5))
+    ax.bar(range(len(records)), [r["p50_ms"] for r in records], label="p50")
+    ax.scatter(range(len(records)), [r["p95_ms"] for r in records], color="red", zorder=3, label="p95")
+    ax.set_xticks(range(len(records)))
+    ax.set_xticklabels(labels, rotation=90, fontsize=7)
+    ax.set_ylabel("latency per call (ms)")
+    ax.set_yscale("log")
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(output)
+
+
+@app.command()
+def run(
+    models: List[str] = ["yolov10b-doclaynet.pt"],
+    batch_sizes: List[int] = [1, 4],
+    threads: List[int] = [4],
+    dpis: List[int] = [150, 300],
+    pages: int = 4,
+    repeat: int = 5,
+    image: Path = "test.png",
+    output: Path = "bench",
+):
+    """Benchmark upload, detect, compare and reclassify on bundled and synthetic fixtures."""
+    import cv2
+    import torch
+    from ultralytics import YOLO
+
+    import detect
+    from compare import compare_layout
+    from reclassify import reclassify_layout, reclassify_snapshot
+    from upload import upload_pdf
+
+    output.mkdir(parents=True, exist_ok=True)
+    image_bytes = image.read_bytes()
+    image_array = cv2.imread(str(image), cv2.IMREAD_COLOR)
+    pdf_bytes = synthetic_pdf(pages)
+    records = []
+
+    for model_path in models:
+        detect.model = YOLO(model_path)
+        for thread_count in threads:
+            torch.set_num_threads(thread_count)
+            cv2.setNumThreads(thread_count)
+            config = {"model": Path(model_path).stem, "threads": thread_count}
+
+            # Warm up so model loading and lazy initialisation are not timed
+            detect.detect_layout(image_bytes)
+
+            measured = measure(lambda: detect.detect_layout(image_bytes), repeat)
+            records.append(summarize("detect", measured, 1, batch=1, dpi=0, **config))
+
+            for batch in batch_sizes:
+                images = [image_array] * batch
+                measured = measure(lambda: detect.model.predict(images, batch=batch, verbose=False), repeat)
+                records.append(summarize("predict", measured, batch, batch=batch, dpi=0, **config))
+
+            for dpi in dpis:
+                with tempfile.TemporaryDirectory() as tmp:
+                    tmp = Path(tmp)
+                    upload_dir, images_dir = tmp / "uploads", tmp / "images"
+                    upload_dir.mkdir()
+                    images_dir.mkdir()
+
+                    state = {}
+                    def upload():
+                        state["upload"] = upload_pdf(SimpleNamespace(file=io.BytesIO(pdf_bytes)), upload_dir, images_dir, dpi)
+
+                    measured = measure(upload, repeat)
+                    records.append(summarize("upload", measured, pages, batch=1, dpi=dpi, **config))
+
+                    file_id, _, text_data, scaling_factors = state["upload"]
+                    layout_data = {file_id: {}}
+                    for page_number in range(1, pages + 1):
+                        page_image = (images_dir / f"{file_id}_page_{page_number}.jpeg").read_bytes()
+                        layout_data[file_id][page_number] = detect.detect_layout(page_image)
+
+                    comparison_results = {}
+                    def compare():
+                        for page_number in range(1, pages + 1):
+                            comparison_results[(file_id, page_number)] = compare_layout(
+                                file_id, page_number, layout_data, text_data, scaling_factors, tmp
+                            )
+
+                    measured = measure(compare, repeat)
+                    records.append(summarize("compare", measured, pages, batch=1, dpi=dpi, **config))
+
+                    def reclassify():
+                        # Clear the memoised results so every repeat does the full work
+                        reclassify_snapshot.cache_clear()
+                        for page_number in range(1, pages + 1):
+                            reclassify_layout(file_id, page_number, comparison_results, layout_data)
+
+                    measured = measure(reclassify, repeat)
+                    records.append(summarize("reclassify", measured, pages, batch=1, dpi=dpi, **config))
+
+    with open(output / "results.json", "w") as f:
+        json.dump(records, f, indent=2)
+    plot(records, output / "plot.png")
+    print(f"results written to {output / 'results.json'} and {output / 'plot.png'}")
+
+
+def dense_page(columns: int, rows: int, chars_per_rect: int):
+    """Layout rects in a grid of overlapping lines, with chars_per_rect glyphs inside each one."""
+    from models import LabelBox
+    from reclassify import TextSnapshot
+
+    labels = ["Text", "Section-header", "List-item", "Caption", "Table"]
+    layout = []
+    text = []
+    for row in range(rows):
+        for column in range(columns):
+            x0, y0 = 50 + column * 300, 50 + row * 40
+            # Boxes slightly wider than their cell so neighbours overlap and lines get combined
+            layout.append(LabelBox(label=labels[(row + column) % len(labels)], box=[x0, y0, x0 + 310, y0 + 36], confidence=0.9))
+            # A duplicate detection nested inside, as YOLO often produces on dense pages
+            layout.append(LabelBox(label="Text", box=[x0 + 4, y0 + 2, x0 + 290, y0 + 30], confidence=0.6))
+            for i in range(chars_per_rect):
+                cx = x0 + 5 + (i % 40) * 7
+                cy = y0 + 5 + (i // 40) * 12
+                text.append(TextSnapshot((cx, cy, cx + 6, cy + 10), "a", f"Font{(row + i) % 3}", 10.0))
+    return layout, text
+
+
+@app.command()
+def trace(columns: int = 4, rows: int = 60, chars_per_rect: int = 10, repeat: int = 7, calls: int = 200000):
+    """Measure the cost of layout pipeline tracing when off, formatted eagerly, and recorded."""
+    import timeit
+
+    from loguru import logger
+
+    import tracing
+    from reclassify import get_tracer, reclassify_snapshot, snapshot_layout
+
+    class EagerTrace(tracing.PageTrace):
+        # Formats and submits every event like the former f-string logger.debug calls did
+        def __call__(self, event, **fields):
+            logger.debug(f"{event} {fields}")
+
+    # DEBUG is filtered out, as in production
+    logger.remove()
+    logger.add(lambda message: None, level="INFO")
+
+    layout, text = dense_page(columns, rows, chars_per_rect)
+    snapshot = (snapshot_layout(layout), tuple(text[::2]), tuple(text[1::2]), ())
+    recorded = tracing.PageTrace()
+    token = tracing.current_trace.set(recorded)
+    reclassify_snapshot.__wrapped__(*snapshot)
+    tracing.current_trace.reset(token)
+    print(f"dense page: {len(layout)} layout rects, {len(text)} text rects, {len(recorded.events)} traced decisions")
+
+    # Per decision: the guarded call site against an eager f-string logger.debug call
+    rect = layout[0]
+    def guarded():
+        trace = get_tracer()
+        if trace:
+            trace("inside_delete", rect=tuple(rect.box), label=rect.label, container=tuple(rect.box))
+    def eager():
+        logger.debug(f"Rect {rect.box} is inside {rect.box}, deleting it.")
+    for name, fn in (("guarded", guarded), ("eager", eager)):
+        seconds = min(timeit.repeat(fn, number=calls, repeat=3))
+        print(f"{name:<10} {seconds / calls * 1e9:8.0f}ns per decision")
+
+    # Per page: modes are interleaved so drift affects them equally
+    modes = {"off": lambda: None, "eager": EagerTrace, "recorded": tracing.PageTrace}
+    timings = {mode: [] for mode in modes}
+    for _ in range(repeat):
+        for mode, make_tracer in modes.items():
+            token = tracing.current_trace.set(make_tracer())
+            start = time.perf_counter()
+            reclassify_snapshot.__wrapped__(*snapshot)
+            timings[mode].append(time.perf_counter() - start)
+            tracing.current_trace.reset(token)
+    for mode, values in timings.items():
+        print(f"{mode:<10} min {min(values) * 1000:8.1f}ms  p50 {statistics.median(values) * 1000:8.1f}ms per page")
+
+if __name__ == "__main__":
+    app()
@@ -1,11 +1,14 @@
 # compare.py
-import json
+from collections.abc import Mapping
 from pathlib import Path
 
 from fastapi import HTTPException
 from loguru import logger
 
 from models import TextRect
+from incremental import PageIndex
+import persist
+from metrics import timer
 
 def convert_pdf_to_image_coords(x0, y0, x1, y1, scale_x, scale_y):
     return [
@@ -15,68 +18,67 @@ def convert_pdf_to_image_coords(x0, y0, x1, y1, scale_x, scale_y):
         y1 * scale_y
     ]
 
-def compare_layout(file_id: str, page_number: int, layout_data: dict, text_data: dict, scaling_factors: dict, output_dir: Path):
-    if file_id not in layout_data or file_id not in text_data:
-        logger.error(f"File ID {file_id} not found in layout_data or text_data.")
-        raise HTTPException(status_code=400, detail="No layout or text data available for this file.")
+class Comparison(Mapping):
+    """
+    Comparison result of a page: its "inside" and "outside" text rects and the "index" they come from.
 
-    layout_rects = layout_data[file_id].get(page_number, [])
-    text_rects = text_data[file_id].get(page_number, [])
+    The lists are read from the page index, so a layout edit only updates the index and the
+    lists are split again on the next read.
+    """
 
-    scale_x, scale_y = scaling_factors.get((file_id, page_number), (1, 1))
+    def __init__(self, page_index: PageIndex):
+        self.index = page_index
 
-    inside = []
-    outside = []
+    def __getitem__(self, key: str):
+        if key == "index":
+            return self.index
+        return self.index.result()[key]
 
-    def get_intersection_area(rect1, rect2):
-        x_left = max(rect1[0], rect2[0])
-        y_top = max(rect1[1], rect2[1])
-        x_right = min(rect1[2], rect2[2])
-        y_bottom = min(rect1[3], rect2[3])
+    def __iter__(self):
+        return iter(("inside", "outside", "index"))
 
-        if x_right < x_left or y_bottom < y_top:
-            return 0.0
+    def __len__(self) -> int:
+        return 3
 
-        return (x_right - x_left) * (y_bottom - y_top)
+def compare_layout(file_id: str, page_number: int, layout_data: dict, text_data: dict, scaling_factors: dict, output_dir: Path, masked_regions: list = None):
+    if file_id not in layout_data or file_id not in text_data:
+        logger.error(f"File ID {file_id} not found in layout_data or text_data.")
+        raise HTTPException(status_code=400, detail="No layout or text data available for this file.")
 
-    def get_area(rect):
-        return (rect[2] - rect[0]) * (rect[3] - rect[1])
+    layout_rects = layout_data[file_id].get(page_number, [])
+    text_rects = text_data[file_id].get(page_number, [])
 
-    def is_significantly_inside(text_rect, layout_rects, threshold=0.5):
-        text_area = get_area(text_rect)
-        for layout_rect in layout_rects:
-            intersection_area = get_intersection_area(text_rect, layout_rect)
-            if intersection_area > 0 and (intersection_area / text_area) >= threshold:
-                return True
-        return False
+    scale_x, scale_y = scaling_factors.get((file_id, page_number), (1, 1))
 
-    for text_rect in text_rects:
-        converted_rect = convert_pdf_to_image_coords(
-            text_rect.box[0], text_rect.box[1], text_rect.box[2], text_rect.box[3], scale_x, scale_y
-        )
+    scaled_text_rects = []
+    with timer("compare_scale"):
+        for text_rect in text_rects:
+            converted_rect = convert_pdf_to_image_coords(
+                text_rect.box[0], text_rect.box[1], text_rect.box[2], text_rect.box[3], scale_x, scale_y
+            )
 
-        scaled_text_rect = TextRect(
-            box=converted_rect,
-            text=text_rect.text,
-            fontname=text_rect.fontname,
-            size=text_rect.size
-        )
+            scaled_text_rects.append(TextRect(
+                box=converted_rect,
+                text=text_rect.text,
+                fontname=text_rect.fontname,
+                size=text_rect.size
+            ))
 
-        if is_significantly_inside(converted_rect, [layout.box for layout in layout_rects], 0.3):
-            inside.append(scaled_text_rect)
-        else:
-            outside.append(scaled_text_rect)
+    # The page index keeps which text rects each layout rect covers, so later edits are incremental
+    with timer("compare_index"):
+        page_index = PageIndex(scaled_text_rects, layout_rects, masked_regions)
 
     # Return the comparison result instead of directly updating comparison_results
-    comparison_result = {"inside": inside, "outside": outside}
+    comparison_result = Comparison(page_index)
 
-    inside_file = output_dir / f"{file_id}_page_{page_number}_inside.json"
-    outside_file = output_dir / f"{file_id}_page_{page_number}_outside.json"
+    save_comparison(file_id, page_number, comparison_result, output_dir)
 
-    with inside_file.open("w", encoding="utf-8") as f:
-        json.dump([rect.dict() for rect in inside], f, ensure_ascii=False, indent=4)
+    return comparison_result
 
-    with outside_file.open("w", encoding="utf-8") as f:
-        json.dump([rect.dict() for rect in outside], f, ensure_ascii=False, indent=4)
+def save_comparison(file_id: str, page_number: int, comparison_result: dict, output_dir: Path):
+    with timer("compare_persist"):
+        persist.save_comparison(output_dir, file_id, page_number, comparison_result["inside"], comparison_result["outside"])
 
-    return comparison_result
+def save_layout_edit(file_id: str, page_number: int, delta: dict, output_dir: Path):
+    with timer("compare_persist"):
+        persist.save_edit(output_dir, file_id, page_number, delta["inside"], delta["outside"])
@@ -0,0 +1,159 @@
+# concurrency.py
+import os
+import threading
+import time
+from typing import Optional
+
+import cv2
+from fastapi import HTTPException
+from loguru import logger
+
+from metrics import Counter, Gauge, register
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+CORES = os.cpu_count() or 1
+
+# Inference concurrency configuration
+class ConcurrencyConfig:
+    # Threads each inference runs on; torch and OpenCV would otherwise each use every core per request
+    inference_threads: int = int(os.environ.get("INFERENCE_THREADS", max(1, min(4, CORES // 2))))
+    # Concurrent inferences stay between min_limit and max_limit, so the threads in use never exceed the cores
+    min_limit: int = 1
+    max_limit: int = int(os.environ.get("INFERENCE_MAX_LIMIT", max(1, CORES // inference_threads)))
+    # Inference latency is compared to the no-load baseline measured on this machine: above
+    # baseline * tolerance counts as congestion and shrinks the limit
+    tolerance: float = float(os.environ.get("INFERENCE_LATENCY_TOLERANCE", "1.5"))
+    # Weight of each inference in the smoothed latencies
+    smoothing: float = 0.2
+    backoff: float = 0.7
+    # Requests waiting for a slot; beyond max_queue they get a 429, after max_wait seconds a 503
+    max_queue: int = int(os.environ.get("INFERENCE_MAX_QUEUE", 2 * max_limit))
+    max_wait: float = float(os.environ.get("INFERENCE_MAX_WAIT", "10.0"))
+
+conf = ConcurrencyConfig()
+
+inference_limit = register(Gauge("doclaynet_inference_limit", "Concurrent inferences currently admitted."))
+inference_inflight = register(Gauge("doclaynet_inference_inflight", "Inferences running."))
+inference_queue_depth = register(Gauge("doclaynet_inference_queue_depth", "Requests waiting for an inference slot."))
+inference_rejected = register(Counter("doclaynet_inference_rejected_total", "Inference requests rejected by reason."))
+
+def configure_threads(threads: int = conf.inference_threads):
+    """Size the torch and OpenCV thread pools for concurrent inferences."""
+    cv2.setNumThreads(threads)
+    if torch is not None:
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Only allowed before torch ran anything in parallel
+            pass
+    logger.info(f"Using {threads} threads per inference on {CORES} cores.")
+
+class AdaptiveLimiter:
+    """
+    Admission control for inference with an AIMD concurrency limit driven by a latency gradient.
+
+    Latency is judged against a baseline, the smoothed latency of inferences that ran alone,
+    so the limiter adapts to however long one inference takes on this hardware and follows it
+    when pages get larger. Starting from min_limit, the limit grows by one per
+    limit completions while the smoothed latency stays within tolerance of the baseline and
+    every slot is used, and shrinks multiplicatively, at most once per inference time, when it
+    is above. Requests beyond the limit wait in a bounded queue instead of each blocking a
+    thread indefinitely.
+    """
+
+    def __init__(self, min_limit: int, max_limit: int, tolerance: float, smoothing: float, backoff: float, max_queue: int, max_wait: float):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.backoff = backoff
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+
+        # Start low, so the baseline is measured without contention
+        self.limit = float(min_limit)
+        self.inflight = 0
+        self.admitted = 0
+        self.waiting = 0
+        self.smoothed = None
+        self.baseline = None
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        self.update_metrics()
+
+    def update_metrics(self):
+        inference_limit.set(int(self.limit))
+        inference_inflight.set(self.inflight)
+        inference_queue_depth.set(self.waiting)
+
+    def retry_after(self) -> str:
+        # Rough time until the queue ahead has drained
+        return str(max(1, round((self.smoothed or 1.0) * (self.waiting + 1) / max(1, int(self.limit)))))
+
+    def acquire(self) -> Optional[int]:
+        """
+        Wait for an inference slot, raising a 429 when the queue is full or a 503 after max_wait.
+
+        Returns:
+            A token to pass to release, set when the inference starts with no other running.
+        """
+        with self.condition:
+            if self.inflight >= int(self.limit):
+                if self.waiting >= self.max_queue:
+                    inference_rejected.inc(reason="queue_full")
+                    raise HTTPException(status_code=429, detail="Too many detection requests queued", headers={"Retry-After": self.retry_after()})
+
+                self.waiting += 1
+                self.update_metrics()
+                deadline = time.monotonic() + self.max_wait
+                try:
+                    while self.inflight >= int(self.limit):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            inference_rejected.inc(reason="timeout")
+                            raise HTTPException(status_code=503, detail="Detection is overloaded", headers={"Retry-After": self.retry_after()})
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                    self.update_metrics()
+
+            alone = self.inflight == 0
+            self.inflight += 1
+            self.admitted += 1
+            self.update_metrics()
+            return self.admitted if alone else None
+
+    def release(self, latency: float, token: Optional[int] = None):
+        """Free a slot and adapt the limit to the latency of the inference that held it."""
+        with self.condition:
+            saturated = self.inflight >= int(self.limit)
+            # It ran alone if it started alone and nothing was admitted since
+            alone = token is not None and token == self.admitted
+            self.inflight -= 1
+
+            if self.smoothed is None:
+                self.smoothed = self.baseline = latency
+            else:
+                self.smoothed += self.smoothing * (latency - self.smoothed)
+                if alone:
+                    self.baseline += self.smoothing * (latency - self.baseline)
+                self.baseline = min(self.baseline, self.smoothed)
+
+            now = time.monotonic()
+            if self.smoothed > self.baseline * self.tolerance:
+                if now - self.last_decrease > self.smoothed:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.last_decrease = now
+                    logger.info(f"Inference takes {self.smoothed:.2f}s against a baseline of {self.baseline:.2f}s, lowering the concurrency limit to {int(self.limit)}.")
+            elif saturated:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.update_metrics()
+            self.condition.notify_all()
+
+limiter = AdaptiveLimiter(conf.min_limit, conf.max_limit, conf.tolerance, conf.smoothing, conf.backoff, conf.max_queue, conf.max_wait)
@@ -1,14 +1,120 @@
+import hashlib
 import json
 import os
+import shutil
+import subprocess
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import tqdm
 import typer
 import yaml
 
+LINK_MODES = ("hardlink", "symlink", "reflink", "copy", "move")
 
-def main(root_folder: Path = "./datasets"):
-    with open(root_folder / "data.yaml", "w") as f:
+# Save the manifest after this many finished images, so an interrupted run loses little work
+MANIFEST_SAVE_EVERY = 5000
+
+
+def iter_coco(path: Path, key: str):
+    """Yield the items of a top level COCO array, streaming them with ijson."""
+    import ijson
+
+    with open(path, "rb") as f:
+        yield from ijson.items(f, f"{key}.item", use_float=True)
+
+
+def load_coco(path: Path, stream: bool):
+    """
+    Return the images of a COCO split and an iterable of its annotations.
+
+    The file is parsed once, unless stream is set, in which case the annotations are streamed
+    by a second pass over it instead of being held in memory.
+    """
+    if stream:
+        return list(iter_coco(path, "images")), iter_coco(path, "annotations")
+    with open(path) as f:
+        coco = json.load(f)
+    return coco["images"], coco["annotations"]
+
+
+def group_labels(annotations, sizes: dict) -> dict:
+    """Group YOLO label lines by image id in a single pass over the annotations."""
+    labels = defaultdict(list)
+    for annotation in annotations:
+        image_id = annotation["image_id"]
+        image_width, image_height = sizes[image_id]
+        left, top, width, height = annotation["bbox"]
+        left /= image_width
+        top /= image_height
+        width /= image_width
+        height /= image_height
+        center_x = left + width / 2
+        center_y = top + height / 2
+        category_id = annotation["category_id"] - 1
+        labels[image_id].append(f"{category_id} {center_x} {center_y} {width} {height}\n")
+    return labels
+
+
+def place_image(src: Path, dst: Path, mode: str):
+    """Place src at dst, skipping it when dst already holds the same image."""
+    if dst.is_symlink() or dst.exists():
+        if mode == "symlink" and dst.is_symlink() and os.readlink(dst) == str(src.resolve()):
+            return
+        if mode == "hardlink" and src.exists() and os.path.samefile(src, dst):
+            return
+        if mode in ("copy", "reflink") and src.exists() and src.stat().st_size == dst.stat().st_size:
+            return
+        if mode == "move" and not src.exists():
+            return
+        dst.unlink()
+
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+        except OSError:
+            # Hardlinks can't cross filesystems
+            shutil.copy2(src, dst)
+    elif mode == "symlink":
+        os.symlink(src.resolve(), dst)
+    elif mode == "reflink":
+        subprocess.run(["cp", "--reflink=always", str(src), str(dst)], check=True)
+    elif mode == "copy":
+        shutil.copy2(src, dst)
+    else:
+        os.rename(src, dst)
+
+
+def load_manifest(path: Path) -> dict:
+    if path.exists():
+        with open(path) as f:
+            return json.load(f)
+    return {"images": {}, "labels": {}}
+
+
+def save_manifest(path: Path, manifest: dict):
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def main(
+    root_folder: Path = "./datasets",
+    workers: int = 8,
+    stream: bool = False,
+    mode: str = "hardlink",
+    output_folder: Path = None,
+):
+    if mode not in LINK_MODES:
+        raise typer.BadParameter(f"mode must be one of {', '.join(LINK_MODES)}")
+
+    # Converting into a separate output folder lets several variants share one DocLayNet copy
+    output_folder = output_folder or root_folder
+    os.makedirs(output_folder, exist_ok=True)
+    with open(output_folder / "data.yaml", "w") as f:
         yaml.dump(
             {
                 "path": "./",
@@ -34,30 +140,69 @@ def main(root_folder: Path = "./datasets"):
 
     for folder in ["val", "test", "train"]:
         print(f"convert {folder} dataset...")
-        os.makedirs(root_folder / "labels" / folder, exist_ok=True)
-        os.makedirs(root_folder / "images" / folder, exist_ok=True)
-        with open(root_folder / "COCO" / f"{folder}.json") as f:
-            bigjson = json.load(f)
-        for image in tqdm.tqdm(bigjson["images"], desc="move images..."):
-            image_id = image["id"]
-            filename = image["file_name"]
-            os.rename(
-                root_folder / "PNG" / filename,
-                root_folder / "images" / folder / f"{image_id}.png",
+        start = time.perf_counter()
+        os.makedirs(output_folder / "labels" / folder, exist_ok=True)
+        os.makedirs(output_folder / "images" / folder, exist_ok=True)
+        coco_path = root_folder / "COCO" / f"{folder}.json"
+
+        # The manifest records finished images and label hashes, so a rerun resumes where it stopped
+        manifest_path = output_folder / f"manifest_{folder}.json"
+        manifest = load_manifest(manifest_path)
+        done_images = manifest["images"]
+
+        images, annotations = load_coco(coco_path, stream)
+        sizes = {image["id"]: (image["width"], image["height"]) for image in images}
+        pending = [
+            image for image in images
+            if done_images.get(str(image["id"])) != mode
+            or not (output_folder / "images" / folder / f"{image['id']}.png").exists()
+        ]
+
+        def convert_image(image):
+            place_image(
+                root_folder / "PNG" / image["file_name"],
+                output_folder / "images" / folder / f"{image['id']}.png",
+                mode,
             )
-        for annotation in tqdm.tqdm(bigjson["annotations"], desc="write labels..."):
-            image_id = annotation["image_id"]
-            filename = f"{image_id}.txt"
-            left, top, width, height = annotation["bbox"]
-            left /= 1025
-            top /= 1025
-            width /= 1025
-            height /= 1025
-            center_x = left + width / 2
-            center_y = top + height / 2
-            category_id = annotation["category_id"] - 1
-            with open(root_folder / "labels" / folder / filename, "a") as f:
-                f.write(f"{category_id} {center_x} {center_y} {width} {height}\n")
+            return image["id"]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            placed = executor.map(convert_image, pending)
+            for count, image_id in enumerate(tqdm.tqdm(placed, total=len(pending), desc=f"{mode} images..."), start=1):
+                done_images[str(image_id)] = mode
+                if count % MANIFEST_SAVE_EVERY == 0:
+                    save_manifest(manifest_path, manifest)
+        save_manifest(manifest_path, manifest)
+
+        labels = group_labels(
+            tqdm.tqdm(annotations, desc="group labels..."), sizes
+        )
+
+        def write_labels(image_id):
+            content = "".join(labels[image_id])
+            digest = hashlib.sha1(content.encode()).hexdigest()
+            label_path = output_folder / "labels" / folder / f"{image_id}.txt"
+            if manifest["labels"].get(str(image_id)) == digest and label_path.exists():
+                return image_id, digest, False
+            with open(label_path, "w") as f:
+                f.write(content)
+            return image_id, digest, True
+
+        written = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(write_labels, labels)
+            for image_id, digest, changed in tqdm.tqdm(results, total=len(labels), desc="write labels..."):
+                manifest["labels"][str(image_id)] = digest
+                written += changed
+        save_manifest(manifest_path, manifest)
+
+        elapsed = time.perf_counter() - start
+        annotation_count = sum(len(lines) for lines in labels.values())
+        print(
+            f"converted {len(pending)} of {len(images)} images and rewrote {written} of {len(labels)} label files "
+            f"({annotation_count} annotations) in {elapsed:.1f}s "
+            f"({len(images) / elapsed:.1f} images/s, {annotation_count / elapsed:.1f} annotations/s)"
+        )
 
 
 if __name__ == "__main__":
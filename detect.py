@@ -1,21 +1,82 @@
 # detect.py
-from typing import List
+from collections import defaultdict
+import threading
+import time
+from typing import Dict, List
 from ultralytics import YOLO
 import cv2
 import numpy as np
-from threading import Semaphore
 from loguru import logger
 
 from models import LabelBox
+from metrics import detections_total, observe_stage, timer
+import concurrency
 
-# YOLO model and semaphore configuration
+# YOLO model configuration, concurrent inferences are set by concurrency.ConcurrencyConfig
 class DetectConfig:
     model_path: str = "yolov10b-doclaynet.pt"
-    max_connections: int = 10
+    # Default confidence threshold, overridden per label by class_thresholds. These are the only
+    # confidence cutoffs, reclassify.py keeps every rect detection returns
+    conf_threshold: float = 0.25
+    class_thresholds: Dict[str, float] = {
+        "Picture": 0.35,
+        "Table": 0.35,
+        "Formula": 0.3,
+        "Title": 0.3,
+    }
+    # Maximum number of detections kept per page and per label
+    max_det: int = 300
+    max_det_per_class: Dict[str, int] = {
+        "Title": 5,
+        "Page-header": 10,
+        "Page-footer": 10,
+    }
 
 conf = DetectConfig()
-model = YOLO(conf.model_path)
-semaphore = Semaphore(conf.max_connections)
+model = None
+model_lock = threading.Lock()
+
+def get_model() -> YOLO:
+    """Load the YOLO model on first use, so importing detect for its thresholds doesn't load it."""
+    global model
+    if model is None:
+        with model_lock:
+            if model is None:
+                concurrency.configure_threads()
+                model = YOLO(conf.model_path)
+    return model
+
+def class_threshold(label: str) -> float:
+    """Return the confidence threshold configured for a label."""
+    return conf.class_thresholds.get(label, conf.conf_threshold)
+
+def filter_detections(names: Dict[int, str], classes: List[float], scores: List[float]) -> List[int]:
+    """
+    Apply per-class confidence thresholds and class-aware max detections.
+
+    Args:
+        names: Mapping from class index to label name.
+        classes: Class index of each detection.
+        scores: Confidence of each detection.
+
+    Returns:
+        Indices of the detections to keep, ordered by descending confidence.
+    """
+    kept = []
+    per_class = defaultdict(int)
+
+    for i in sorted(range(len(scores)), key=lambda i: scores[i], reverse=True):
+        label = names[int(classes[i])]
+        if scores[i] < class_threshold(label):
+            continue
+        if per_class[label] >= conf.max_det_per_class.get(label, conf.max_det):
+            continue
+        per_class[label] += 1
+        kept.append(i)
+        if len(kept) >= conf.max_det:
+            break
+
+    return kept
 
 def detect_layout(image_data: bytes) -> List[LabelBox]:
     """
@@ -24,32 +85,65 @@ def detect_layout(image_data: bytes) -> List[LabelBox]:
     Args:
         image_data: The image data in bytes format.
 
+    Returns:
+        A list of detected LabelBox objects.
+    """
+    with timer("detect_decode"):
+        image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        logger.error("Invalid image")
+        return []
+
+    return detect_image(image)
+
+def detect_image(image: np.ndarray, scale: float = 1.0) -> List[LabelBox]:
+    """
+    Perform object detection on an already decoded BGR image.
+
+    Args:
+        image: The image as a BGR array, e.g. a page rendered by upload.render_page.
+        scale: Scale of image relative to the full page, boxes are returned at full page resolution.
+
     Returns:
         A list of detected LabelBox objects.
     """
     logger.info("Starting object detection...")
 
-    with semaphore:
-        image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
-        if image is None:
-            logger.error("Invalid image")
-            return []
+    # Raises a 429 or 503 instead of queueing without bound when inference is saturated
+    with timer("detect_wait"):
+        token = concurrency.limiter.acquire()
+    start = time.perf_counter()
+    try:
+        # Let YOLO drop everything below the lowest threshold before NMS
+        min_conf = min([conf.conf_threshold, *conf.class_thresholds.values()])
+        result = get_model().predict(image, conf=min_conf, max_det=conf.max_det, verbose=False)[0]
+    finally:
+        concurrency.limiter.release(time.perf_counter() - start, token)
 
-        result = model.predict(image, verbose=False)[0]
+    # YOLO times its own preprocess, inference and postprocess in milliseconds
+    for stage, milliseconds in result.speed.items():
+        observe_stage(f"detect_{stage}", milliseconds / 1000)
     
-    height = result.orig_shape[0]
-    width = result.orig_shape[1]
+    height = result.orig_shape[0] / scale
+    width = result.orig_shape[1] / scale
     label_boxes = []
 
-    for label, box in zip(result.boxes.cls.tolist(), result.boxes.xyxyn.tolist()):
-        label_boxes.append(
-            LabelBox(
-                label=result.names[int(label)],
-                box=[box[0] * width, box[1] * height, box[2] * width, box[3] * height],
+    classes = result.boxes.cls.tolist()
+    scores = result.boxes.conf.tolist()
+    boxes = result.boxes.xyxyn.tolist()
+
+    with timer("detect_filter"):
+        for i in filter_detections(result.names, classes, scores):
+            box = boxes[i]
+            label_boxes.append(
+                LabelBox(
+                    label=result.names[int(classes[i])],
+                    box=[box[0] * width, box[1] * height, box[2] * width, box[3] * height],
+                    confidence=scores[i],
+                )
             )
-        )
+            detections_total.inc(label=label_boxes[-1].label)
 
-    logger.info(f"Detected {len(label_boxes)} objects, Image size: {width}x{height}")
+    logger.info(f"Detected {len(label_boxes)} objects (of {len(classes)} candidates), Image size: {width:.0f}x{height:.0f}")
     
     return label_boxes
-
@@ -1,15 +1,201 @@
+import json
+import statistics
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
 import typer
+import yaml
 from ultralytics import YOLO
 
+# IoU thresholds of mAP50-95
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+# Stages of the pipeline report and their titles, each scored on the output of the one before
+STAGES = {
+    "detect": "detect",
+    "reclassify": "reclassify",
+}
+
+
+def box_iou(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """IoU between one xyxy box and an array of xyxy boxes."""
+    x0 = np.maximum(box[0], boxes[:, 0])
+    y0 = np.maximum(box[1], boxes[:, 1])
+    x1 = np.minimum(box[2], boxes[:, 2])
+    y1 = np.minimum(box[3], boxes[:, 3])
+    intersection = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / np.maximum(area + areas - intersection, 1e-9)
+
+
+def average_precision(recall: np.ndarray, precision: np.ndarray) -> float:
+    """COCO style 101-point interpolated average precision."""
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    points = np.linspace(0, 1, 101)
+    indices = np.searchsorted(recall, points, side="left")
+    return float(np.mean([precision[i] if i < len(precision) else 0.0 for i in indices]))
+
+
+def class_map(predictions: List[tuple], ground_truth: Dict[str, np.ndarray]) -> float:
+    """
+    mAP50-95 of one class.
+
+    Args:
+        predictions: (image, confidence, xyxy box) of every prediction of the class.
+        ground_truth: xyxy boxes of the class by image.
+
+    Returns:
+        The average precision over IOU_THRESHOLDS.
+    """
+    total = sum(len(boxes) for boxes in ground_truth.values())
+    if total == 0:
+        return float("nan")
+
+    predictions = sorted(predictions, key=lambda p: p[1], reverse=True)
+    aps = []
+    for threshold in IOU_THRESHOLDS:
+        matched = {image: np.zeros(len(boxes), dtype=bool) for image, boxes in ground_truth.items()}
+        true_positives = np.zeros(len(predictions))
+        for i, (image, _, box) in enumerate(predictions):
+            boxes = ground_truth.get(image)
+            if boxes is None or len(boxes) == 0:
+                continue
+            ious = np.where(matched[image], 0.0, box_iou(np.asarray(box), boxes))
+            best = int(np.argmax(ious))
+            if ious[best] >= threshold:
+                matched[image][best] = True
+                true_positives[i] = 1
+        cumulative = np.cumsum(true_positives)
+        recall = cumulative / total
+        precision = cumulative / np.arange(1, len(predictions) + 1)
+        aps.append(average_precision(recall, precision) if len(predictions) else 0.0)
+    return float(np.mean(aps))
+
+
+def read_ground_truth(label_path: Path, width: int, height: int, names: Dict[int, str]) -> Dict[str, list]:
+    boxes = defaultdict(list)
+    if label_path.exists():
+        for line in label_path.read_text().splitlines():
+            category, center_x, center_y, box_width, box_height = map(float, line.split())
+            boxes[names[int(category)]].append([
+                (center_x - box_width / 2) * width,
+                (center_y - box_height / 2) * height,
+                (center_x + box_width / 2) * width,
+                (center_y + box_height / 2) * height,
+            ])
+    return boxes
+
+
+def percentiles(timings: List[float]) -> dict:
+    timings = sorted(timings)
+    return {
+        "p50_ms": statistics.median(timings) * 1000,
+        "p95_ms": timings[min(len(timings) - 1, round(0.95 * (len(timings) - 1)))] * 1000,
+    }
+
+
+def evaluate_pipeline(model: YOLO, datasets: str, split: str, batch: int, report: Path):
+    """
+    Run detect and reclassify over a split and report per-class mAP50-95 after each stage.
+
+    Detections are filtered with the thresholds detect.py serves with, so reclassify is scored
+    on the layouts it gets when serving.
+    """
+    import detect
+    from models import LabelBox
+    from reclassify import reclassify_snapshot, snapshot_layout
+
+    with open(datasets) as f:
+        data = yaml.safe_load(f)
+    images_dir = Path(datasets).parent / data["path"] / data[split]
+    labels_dir = Path(str(images_dir).replace("images", "labels"))
+    names = {int(k): v for k, v in data["names"].items()}
+    image_paths = sorted(images_dir.glob("*.png"))
+    min_conf = min([detect.conf.conf_threshold, *detect.conf.class_thresholds.values()])
+
+    ground_truth = defaultdict(dict)  # label -> image -> boxes
+    predictions = {stage: defaultdict(list) for stage in STAGES}  # stage -> label -> predictions
+    timings = defaultdict(list)
+
+    for start in range(0, len(image_paths), batch):
+        paths = image_paths[start:start + batch]
+        detect_start = time.perf_counter()
+        results = model.predict([str(path) for path in paths], conf=min_conf, max_det=detect.conf.max_det, batch=batch, verbose=False)
+        per_image = (time.perf_counter() - detect_start) / len(paths)
+
+        for path, result in zip(paths, results):
+            timings["detect"].append(per_image)
+            height, width = result.orig_shape
+            for label, boxes in read_ground_truth(labels_dir / f"{path.stem}.txt", width, height, names).items():
+                ground_truth[label][path.stem] = np.asarray(boxes)
+
+            classes = result.boxes.cls.tolist()
+            scores = result.boxes.conf.tolist()
+            boxes = result.boxes.xyxy.tolist()
+            label_boxes = [
+                LabelBox(label=result.names[int(classes[i])], box=boxes[i], confidence=scores[i])
+                for i in detect.filter_detections(result.names, classes, scores)
+            ]
+
+            # DocLayNet core has no text cells, so only the layout passes of reclassify run here
+            reclassify_start = time.perf_counter()
+            reclassified = reclassify_snapshot(snapshot_layout(label_boxes), (), (), ())
+            timings["reclassify"].append(time.perf_counter() - reclassify_start)
+
+            for stage, layout in (("detect", snapshot_layout(label_boxes)), ("reclassify", reclassified)):
+                for label, box, confidence in layout:
+                    predictions[stage][label].append((path.stem, confidence, list(box)))
+
+    per_class = {}
+    for label in names.values():
+        per_class[label] = {"boxes": sum(len(boxes) for boxes in ground_truth[label].values())}
+        for stage in STAGES:
+            per_class[label][stage] = class_map(predictions[stage][label], ground_truth[label])
+    valid = [stats for stats in per_class.values() if stats["boxes"]]
+    overall = {stage: float(np.mean([stats[stage] for stats in valid])) if valid else float("nan") for stage in STAGES}
+    latency = {stage: percentiles(values) for stage, values in timings.items()}
+
+    report.mkdir(parents=True, exist_ok=True)
+    with open(report / "report.json", "w") as f:
+        json.dump({"images": len(image_paths), "per_class": per_class, "all": overall, "latency": latency}, f, indent=2)
+
+    lines = ["| label | boxes | " + " | ".join(f"mAP50-95 {title}" for title in STAGES.values()) + " | delta |", "|---|---|" + "---|" * (len(STAGES) + 1)]
+    for label, stats in [*per_class.items(), ("**All**", {"boxes": sum(s["boxes"] for s in valid), **overall})]:
+        maps = " | ".join(f"{stats[stage]:.3f}" for stage in STAGES)
+        lines.append(f"| {label} | {stats['boxes']} | {maps} | {stats['reclassify'] - stats['detect']:+.3f} |")
+
+    lines += ["", "| stage | p50 (ms) | p95 (ms) |", "|---|---|---|"]
+    for stage, stats in latency.items():
+        lines.append(f"| {stage} | {stats['p50_ms']:.1f} | {stats['p95_ms']:.1f} |")
+    (report / "report.md").write_text("\n".join(lines) + "\n")
+    print("\n".join(lines))
+
 
 def main(
     model: str,
     datasets: str = "./datasets/data.yaml",
     split: str = "test",
     batch: int = 8,
+    packed: bool = False,
+    pipeline: bool = False,
+    report: Path = "eval_report",
 ):
+    validator = None
+    if packed:
+        # datasets points at the data.yaml written by pack.py
+        from packed import PackedValidator
+
+        validator = PackedValidator
+
     model = YOLO(model)
-    metrics = model.val(data=datasets, split=split, batch=batch)
+    if pipeline:
+        evaluate_pipeline(model, datasets, split, batch, report)
+        return
+
+    metrics = model.val(validator=validator, data=datasets, split=split, batch=batch)
     print(metrics)
 
 
@@ -0,0 +1,213 @@
+# extract.py
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+import pdfplumber
+
+from models import TextRect
+from metrics import timer
+
+# Lazy text extraction configuration
+class ExtractConfig:
+    # Open PDF handles kept for extraction, closed least recently used first
+    max_open_documents: int = 16
+    workers: int = 4
+    # Prefetching runs on its own pool, with at most prefetch_window pages of a document queued at a
+    # time, so pages read on demand never wait behind every page of a large upload
+    prefetch_workers: int = 2
+    prefetch_window: int = 4
+
+conf = ExtractConfig()
+executor = ThreadPoolExecutor(max_workers=conf.workers, thread_name_prefix="extract")
+prefetch_executor = ThreadPoolExecutor(max_workers=conf.prefetch_workers, thread_name_prefix="extract-prefetch")
+
+def extract_text_rects(page: pdfplumber.page.Page) -> List[TextRect]:
+    """Extract the printable characters of a page as text rects."""
+    text_rects = []
+    for char in page.chars:
+        text = char["text"]
+        if not text.strip() or not any(c.isprintable() for c in text):
+            continue
+
+        rect = TextRect(
+            box=[char["x0"], char["top"], char["x1"], char["bottom"]],
+            text=text,
+            fontname=char["fontname"],
+            size=round(char["size"])
+        )
+        text_rects.append(rect)
+    return text_rects
+
+class Handle:
+    """An open document, with a lock since pdfminer is not thread-safe and a count of its users."""
+
+    def __init__(self, pdf: pdfplumber.PDF):
+        self.pdf = pdf
+        self.lock = threading.Lock()
+        self.users = 0
+        self.evicted = False
+
+class HandleCache:
+    """
+    Bounded LRU of open pdfplumber documents.
+
+    A document evicted while in use stays open until its last user releases it, so an
+    extraction never sees its document closed underneath it.
+    """
+
+    def __init__(self, max_open: int):
+        self.max_open = max_open
+        self.handles: "OrderedDict[Path, Handle]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, file_path: Path) -> Handle:
+        """Return the open document, opening it if needed; every acquire must be followed by a release."""
+        with self.lock:
+            handle = self.handles.get(file_path)
+            if handle is None:
+                handle = Handle(pdfplumber.open(file_path))
+                self.handles[file_path] = handle
+            self.handles.move_to_end(file_path)
+            # Counted while still holding the cache lock, so no eviction can close it before the caller uses it
+            handle.users += 1
+            while len(self.handles) > self.max_open:
+                self.evict(self.handles.popitem(last=False)[1])
+        return handle
+
+    def release(self, handle: Handle):
+        with self.lock:
+            handle.users -= 1
+            if handle.evicted and handle.users == 0:
+                handle.pdf.close()
+
+    @contextmanager
+    def open(self, file_path: Path):
+        """Use an open document under its lock."""
+        handle = self.acquire(file_path)
+        try:
+            with handle.lock:
+                yield handle.pdf
+        finally:
+            self.release(handle)
+
+    def evict(self, handle: Handle):
+        # Called with self.lock held; users only change under it, so an unused handle stays unused
+        handle.evicted = True
+        if handle.users == 0:
+            handle.pdf.close()
+
+    def close(self, file_path: Path):
+        with self.lock:
+            handle = self.handles.pop(file_path, None)
+            if handle is not None:
+                self.evict(handle)
+
+handles = HandleCache(conf.max_open_documents)
+
+class DocumentText(Mapping):
+    """
+    Text rects of a document by page_number, extracted the first time a page is read.
+
+    Extraction runs on the extract worker pool and is memoised per page, so concurrent readers
+    of the same page share one extraction. Prefetched pages run on a separate pool, a few at a
+    time, and a read of a page still queued for prefetch extracts it on the main pool instead.
+    """
+
+    def __init__(self, file_path: Path, page_count: int):
+        self.file_path = file_path
+        self.page_count = page_count
+        self.pages: Dict[int, Future] = {}
+        self.queued = deque()  # Pages waiting to be prefetched
+        self.prefetches: Set[Future] = set()  # Prefetches submitted and not finished
+        self.lock = threading.Lock()
+
+    def __getitem__(self, page_number: int) -> List[TextRect]:
+        if not 1 <= page_number <= self.page_count:
+            raise KeyError(page_number)
+        return self.submit(page_number).result()
+
+    def __iter__(self):
+        return iter(range(1, self.page_count + 1))
+
+    def __len__(self):
+        return self.page_count
+
+    def submit(self, page_number: int) -> Future:
+        """Start extracting a page in the background, if it isn't extracted or being extracted."""
+        with self.lock:
+            future = self.pages.get(page_number)
+            if future in self.prefetches and future.cancel():
+                # The page was only queued for prefetch, so extract it on the main pool right away
+                future = None
+            if future is None or (future.done() and future.exception() is not None):
+                future = executor.submit(self.extract, page_number)
+                self.pages[page_number] = future
+        return future
+
+    def prefetch(self, page_numbers=None):
+        """Extract pages in the background ahead of their first read, prefetch_window at a time."""
+        with self.lock:
+            self.queued.extend(page_numbers or self)
+        for _ in range(conf.prefetch_window):
+            self.prefetch_next()
+
+    def prefetch_next(self, finished: Future = None):
+        # Called again as each prefetch finishes, keeping the window full until the queue is empty
+        with self.lock:
+            self.prefetches.discard(finished)
+            while self.queued:
+                page_number = self.queued.popleft()
+                if page_number not in self.pages:
+                    try:
+                        future = prefetch_executor.submit(self.extract, page_number)
+                    except RuntimeError:
+                        # The pool is shut down at exit
+                        self.queued.clear()
+                        return
+                    self.pages[page_number] = future
+                    self.prefetches.add(future)
+                    break
+            else:
+                return
+        future.add_done_callback(self.prefetch_next)
+
+    def cancel_prefetch(self):
+        """Drop the pages still queued for prefetch, e.g. when the document is deleted."""
+        with self.lock:
+            self.queued.clear()
+            prefetches = list(self.prefetches)
+        for future in prefetches:
+            future.cancel()
+
+    def peek(self, page_number: int) -> Optional[List[TextRect]]:
+        """Return the text rects of a page only if they are already extracted."""
+        future = self.pages.get(page_number)
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return future.result()
+
+    def extract(self, page_number: int) -> List[TextRect]:
+        with handles.open(self.file_path) as pdf, timer("upload_extract"):
+            page = pdf.pages[page_number - 1]
+            try:
+                return extract_text_rects(page)
+            finally:
+                # Drop pdfplumber's cached objects for the page, the text rects are all we keep
+                page.flush_cache()
+
+    def clipped(self, page_number: int, clip: List[float]) -> List[TextRect]:
+        """
+        Text rects of a page that intersect clip (PDF coordinates).
+
+        pdfplumber parses the whole page even to crop it, so the page is extracted once through
+        the memoised extraction and every clip of it is filtered from that.
+        """
+        return [
+            rect for rect in self[page_number]
+            if rect.box[0] < clip[2] and rect.box[2] > clip[0] and rect.box[1] < clip[3] and rect.box[3] > clip[1]
+        ]
@@ -0,0 +1,75 @@
+# font_stats.py
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Optional, Tuple
+
+from incremental import PageIndex
+
+FontKey = Tuple[str, float]
+# Most common label of every font of a document, frozen so it can key memoised results
+FontLabels = Tuple[Tuple[FontKey, str], ...]
+
+def count_page_fonts(page_index: PageIndex) -> Counter:
+    """
+    Count the labels of the text rects of a page by font.
+
+    Each covered text rect counts once, for the first layout rect covering it, reusing the
+    covers already kept by the page index instead of testing every text rect against every
+    layout rect.
+
+    Returns:
+        A Counter of ((font name, font size), label) pairs.
+    """
+    counts = Counter()
+    counted = set()
+    for rect, covered in zip(page_index.layout_rects, page_index.covers):
+        for i in covered - counted:
+            text_rect = page_index.text_rects[i]
+            counts[((text_rect.fontname, text_rect.size), rect.label)] += 1
+        counted |= covered
+    return counts
+
+class FontStatistics:
+    """
+    Font to label counts of a whole document, accumulated page by page.
+
+    Replacing a page subtracts its previous counts, so comparing a page again or editing its
+    layout keeps the totals exact without revisiting the other pages.
+    """
+
+    def __init__(self):
+        self.pages: Dict[int, Counter] = {}
+        self.counts: Dict[FontKey, Counter] = defaultdict(Counter)
+        self.lock = threading.Lock()
+        self.frozen: Optional[FontLabels] = None
+
+    def replace_page(self, page_number: int, page_counts: Counter):
+        with self.lock:
+            for (font_key, label), count in self.pages.get(page_number, Counter()).items():
+                self.counts[font_key][label] -= count
+                if self.counts[font_key][label] <= 0:
+                    del self.counts[font_key][label]
+                if not self.counts[font_key]:
+                    del self.counts[font_key]
+            for (font_key, label), count in page_counts.items():
+                self.counts[font_key][label] += count
+            self.pages[page_number] = page_counts
+            self.frozen = None
+
+    def label(self, font_key: FontKey, default: str = None) -> Optional[str]:
+        """Return the most common label of a font across the document."""
+        with self.lock:
+            label_counts = self.counts.get(font_key)
+            if not label_counts:
+                return default
+            return max(label_counts, key=label_counts.get)
+
+    def labels(self) -> FontLabels:
+        """Return the most common label of every font, rebuilt only after a page changed."""
+        with self.lock:
+            if self.frozen is None:
+                self.frozen = tuple(sorted(
+                    (font_key, max(label_counts, key=label_counts.get))
+                    for font_key, label_counts in self.counts.items()
+                ))
+            return self.frozen
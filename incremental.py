@@ -0,0 +1,195 @@
+# incremental.py
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+
+from loguru import logger
+
+from models import LabelBox, TextRect
+from repeating import in_regions
+from tracing import get_tracer
+
+# Cell size (in image pixels) of the grid used to look up text rects near a layout rect
+GRID_SIZE = 64.0
+# Fraction of a text rect's area that must fall inside a layout rect
+INSIDE_THRESHOLD = 0.3
+
+def get_intersection_area(rect1: List[float], rect2: List[float]) -> float:
+    x_left = max(rect1[0], rect2[0])
+    y_top = max(rect1[1], rect2[1])
+    x_right = min(rect1[2], rect2[2])
+    y_bottom = min(rect1[3], rect2[3])
+
+    if x_right < x_left or y_bottom < y_top:
+        return 0.0
+
+    return (x_right - x_left) * (y_bottom - y_top)
+
+def get_area(rect: List[float]) -> float:
+    return (rect[2] - rect[0]) * (rect[3] - rect[1])
+
+def grid_cells(box: List[float]) -> List[Tuple[int, int]]:
+    """Return the grid cells covered by box."""
+    x0, y0 = int(box[0] // GRID_SIZE), int(box[1] // GRID_SIZE)
+    x1, y1 = int(box[2] // GRID_SIZE), int(box[3] // GRID_SIZE)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+class PageIndex:
+    """
+    Dependency structure between the layout rects and the text rects of one page.
+
+    Each layout rect keeps the set of text rects significantly inside it, and each text rect
+    keeps how many layout rects cover it. Adding, removing or moving a layout rect then only
+    revisits the text rects in the grid cells it touches, and the inside/outside lists are only
+    split again when read after a change.
+    """
+
+    def __init__(self, text_rects: List[TextRect], layout_rects: List[LabelBox], masked_regions: List[LabelBox] = None, threshold: float = INSIDE_THRESHOLD):
+        self.text_rects = text_rects
+        self.layout_rects: List[LabelBox] = []
+        self.threshold = threshold
+
+        self.grid: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        for i, rect in enumerate(text_rects):
+            for cell in grid_cells(rect.box):
+                self.grid[cell].append(i)
+
+        # Text inside repeating header/footer regions is always inside
+        masked_boxes = [region.box for region in masked_regions or []]
+        self.masked: Set[int] = {i for i, rect in enumerate(text_rects) if masked_boxes and in_regions(rect.box, masked_boxes)}
+
+        self.covers: List[Set[int]] = []  # Text rects inside each layout rect
+        self.cover_counts = [0] * len(text_rects)  # Layout rects covering each text rect
+        self.split: Dict[str, List[TextRect]] = None  # Last result, until a text rect changes state
+
+        for rect in layout_rects:
+            self.add(rect)
+
+    def candidates(self, box: List[float]) -> Set[int]:
+        """Return the text rects sharing a grid cell with box."""
+        found = set()
+        for cell in grid_cells(box):
+            found.update(self.grid.get(cell, ()))
+        return found
+
+    def covered_text(self, box: List[float]) -> Set[int]:
+        """Return the text rects significantly inside box."""
+        covered = set()
+        for i in self.candidates(box):
+            if i in self.masked:
+                continue
+            text_box = self.text_rects[i].box
+            intersection_area = get_intersection_area(text_box, box)
+            if intersection_area > 0 and (intersection_area / get_area(text_box)) >= self.threshold:
+                covered.add(i)
+        return covered
+
+    def neighbours(self, index: int) -> Set[int]:
+        """Return the layout rects sharing at least one text rect with the layout rect at index."""
+        return {j for j, covered in enumerate(self.covers) if j != index and covered & self.covers[index]}
+
+    def add(self, rect: LabelBox) -> Set[int]:
+        """Add a layout rect and return the text rects whose inside/outside state changed."""
+        covered = self.covered_text(rect.box)
+        self.layout_rects.append(rect)
+        self.covers.append(covered)
+
+        trace = get_tracer()
+        if trace:
+            trace("text_cover", rect=tuple(rect.box), label=rect.label, covered=len(covered))
+
+        changed = set()
+        for i in covered:
+            self.cover_counts[i] += 1
+            if self.cover_counts[i] == 1:
+                changed.add(i)
+        self.invalidate(changed)
+        return changed
+
+    def remove(self, index: int) -> Set[int]:
+        """Remove the layout rect at index and return the text rects whose state changed."""
+        self.layout_rects.pop(index)
+        covered = self.covers.pop(index)
+
+        changed = set()
+        for i in covered:
+            self.cover_counts[i] -= 1
+            if self.cover_counts[i] == 0:
+                changed.add(i)
+        self.invalidate(changed)
+        return changed
+
+    def move(self, index: int, rect: LabelBox) -> Set[int]:
+        """Replace the layout rect at index and return the text rects whose state changed."""
+        old_covered = self.covers[index]
+        new_covered = self.covered_text(rect.box)
+        self.layout_rects[index] = rect
+        self.covers[index] = new_covered
+
+        changed = set()
+        for i in old_covered - new_covered:
+            self.cover_counts[i] -= 1
+            if self.cover_counts[i] == 0:
+                changed.add(i)
+        for i in new_covered - old_covered:
+            self.cover_counts[i] += 1
+            if self.cover_counts[i] == 1:
+                changed.add(i)
+        self.invalidate(changed)
+        return changed
+
+    def invalidate(self, changed: Set[int]):
+        if changed:
+            self.split = None
+
+    def is_inside(self, i: int) -> bool:
+        return self.cover_counts[i] > 0 or i in self.masked
+
+    def result(self) -> Dict[str, List[TextRect]]:
+        """Split the text rects into inside and outside, keeping their original order."""
+        split = self.split
+        if split is None:
+            inside = []
+            outside = []
+            for i, rect in enumerate(self.text_rects):
+                if self.is_inside(i):
+                    inside.append(rect)
+                else:
+                    outside.append(rect)
+            split = self.split = {"inside": inside, "outside": outside}
+        return split
+
+    def delta(self, changed: Set[int]) -> Dict[str, List[Tuple[int, TextRect]]]:
+        """Return the changed text rects that are now inside and outside, with their positions."""
+        delta = {"inside": [], "outside": []}
+        for i in sorted(changed):
+            delta["inside" if self.is_inside(i) else "outside"].append((i, self.text_rects[i]))
+        return delta
+
+def apply_layout_edit(page_index: PageIndex, op: str, index: int = None, rect: LabelBox = None) -> Tuple[Set[int], Set[int]]:
+    """
+    Apply one layout edit to a page index.
+
+    Args:
+        page_index: The PageIndex of the edited page.
+        op: One of "add", "remove" or "move".
+        index: Position of the edited layout rect, for "remove" and "move".
+        rect: The new layout rect, for "add" and "move".
+
+    Returns:
+        The text rects whose inside/outside state changed and the neighbouring layout rects affected.
+    """
+    if op == "add":
+        changed = page_index.add(rect)
+        neighbours = page_index.neighbours(len(page_index.layout_rects) - 1)
+    elif op == "remove":
+        neighbours = {j if j < index else j - 1 for j in page_index.neighbours(index)}
+        changed = page_index.remove(index)
+    elif op == "move":
+        neighbours = page_index.neighbours(index)
+        changed = page_index.move(index, rect)
+        neighbours |= page_index.neighbours(index)
+    else:
+        raise ValueError(f"Unknown layout edit operation: {op}")
+
+    logger.info(f"Layout edit {op} changed {len(changed)} text rects and touched {len(neighbours)} neighbouring rects.")
+    return changed, neighbours
@@ -0,0 +1,388 @@
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from queue import Empty, Queue
+from typing import Dict, List, Optional
+
+import requests
+import typer
+
+from bench import process_rss_mb, synthetic_pdf
+
+app = typer.Typer()
+
+# Steps run on every visited page, in pipeline order
+PAGE_STEPS = ("image", "detect", "compare", "reclassify")
+
+
+def page_steps(page_count: int, visit_ratio: float, rng: random.Random) -> List[dict]:
+    """Visit a share of the pages in reading order, running the page pipeline on each."""
+    visited = sorted(rng.sample(range(1, page_count + 1), max(1, round(page_count * visit_ratio))))
+    return [{"op": op, "page": page, **({"size": "screen"} if op == "image" else {})} for page in visited for op in PAGE_STEPS]
+
+
+def pdf_page_count(path: Path) -> int:
+    import pdfplumber
+
+    with pdfplumber.open(path) as pdf:
+        return len(pdf.pages)
+
+
+def write_sessions(sessions: List[dict], output: Path):
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open("w", encoding="utf-8") as f:
+        for session in sessions:
+            f.write(json.dumps(session) + "\n")
+    print(f"{len(sessions)} sessions written to {output}")
+
+
+@app.command()
+def synthesize(
+    sessions: int = 50,
+    min_pages: int = 1,
+    max_pages: int = 20,
+    visit_ratio: float = 0.5,
+    think_time: float = 0.5,
+    seed: int = 0,
+    output: Path = "loadtest/sessions.jsonl",
+):
+    """Write sessions uploading synthetic multi-page PDFs and running detect, compare and reclassify on their pages."""
+    rng = random.Random(seed)
+    records = []
+    for number in range(sessions):
+        pages = rng.randint(min_pages, max_pages)
+        records.append({
+            "session": f"synthetic-{number:05d}",
+            "pdf": {"synthetic": {"pages": pages, "lines": rng.randint(10, 50)}},
+            "think_time": think_time,
+            "steps": [{"op": "upload", "include_text": False, "render_images": rng.random() < 0.5}] + page_steps(pages, visit_ratio, rng),
+        })
+    write_sessions(records, output)
+
+
+@app.command()
+def record(
+    source: Path,
+    visit_ratio: float = 0.5,
+    think_time: float = 0.5,
+    seed: int = 0,
+    output: Path = "loadtest/sessions.jsonl",
+):
+    """Write one session per PDF found in source, so replays use real documents."""
+    rng = random.Random(seed)
+    paths = [source] if source.is_file() else sorted(source.rglob("*.pdf"))
+    records = []
+    for path in paths:
+        pages = pdf_page_count(path)
+        records.append({
+            "session": path.stem,
+            "pdf": {"path": str(path.resolve())},
+            "think_time": think_time,
+            "steps": [{"op": "upload", "include_text": False, "render_images": False}] + page_steps(pages, visit_ratio, rng),
+        })
+    write_sessions(records, output)
+
+
+class Pacer:
+    """Spaces requests of all workers to at most rps per second; rps 0 disables pacing."""
+
+    def __init__(self, rps: float):
+        self.interval = 1 / rps if rps > 0 else 0.0
+        self.next_time = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.perf_counter()
+            slot = max(self.next_time, now)
+            self.next_time = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+class Replay:
+    """Replays sessions against a server, recording the outcome of every request."""
+
+    def __init__(self, url: str, pacer: Pacer, timeout: float):
+        self.url = url.rstrip("/")
+        self.pacer = pacer
+        self.timeout = timeout
+        self.pdfs: Dict[str, bytes] = {}
+        self.pdfs_lock = threading.Lock()
+        self.results: List[dict] = []
+        self.results_lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def pdf_bytes(self, spec: dict) -> bytes:
+        key = json.dumps(spec, sort_keys=True)
+        with self.pdfs_lock:
+            if key not in self.pdfs:
+                if "synthetic" in spec:
+                    self.pdfs[key] = synthetic_pdf(**spec["synthetic"])
+                else:
+                    self.pdfs[key] = Path(spec["path"]).read_bytes()
+            return self.pdfs[key]
+
+    def send(self, http: requests.Session, step: dict, file_id: Optional[str], pdf: bytes) -> requests.Response:
+        op = step["op"]
+        page = {"file_id": file_id, "page_number": step.get("page")}
+        if op == "upload":
+            params = {"include_text": str(step.get("include_text", False)).lower(), "render_images": str(step.get("render_images", True)).lower()}
+            return http.post(f"{self.url}/upload-pdf/", params=params, files={"file": ("document.pdf", pdf, "application/pdf")}, timeout=self.timeout)
+        if op == "detect":
+            return http.post(f"{self.url}/api/detect", files={key: (None, str(value)) for key, value in page.items()}, timeout=self.timeout)
+        if op in ("compare", "reclassify"):
+            return http.post(f"{self.url}/{op}", json=page, timeout=self.timeout)
+        if op == "repeating":
+            return http.post(f"{self.url}/repeating", json={"file_id": file_id}, timeout=self.timeout)
+        if op == "image":
+            return http.get(f"{self.url}/get-image/{file_id}/{step['page']}", params={"size": step.get("size", "full")}, timeout=self.timeout)
+        if op == "text":
+            return http.get(f"{self.url}/text/{file_id}/{step['page']}", timeout=self.timeout)
+        raise ValueError(f"Unknown step {op}")
+
+    def run_session(self, http: requests.Session, session: dict, deadline: Optional[float] = None):
+        pdf = self.pdf_bytes(session["pdf"])
+        file_id = None
+        for step in session["steps"]:
+            if step["op"] != "upload" and file_id is None:
+                # The upload failed, the rest of the session can't run
+                break
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+
+            self.pacer.wait()
+            started = time.perf_counter()
+            try:
+                response = self.send(http, step, file_id, pdf)
+                status, size = response.status_code, len(response.content)
+            except requests.RequestException as e:
+                response, status, size = None, type(e).__name__, 0
+            latency = time.perf_counter() - started
+
+            if step["op"] == "upload" and response is not None and response.ok:
+                pages = response.json()
+                if pages:
+                    # The file_id is the path segment after /get-image/ in image_url
+                    file_id = pages[0]["image_url"].split("/")[2]
+                else:
+                    # Counted as an error, and the rest of the session is skipped since it has no pages to request
+                    status = "empty_upload"
+
+            with self.results_lock:
+                self.results.append({
+                    "session": session["session"], "op": step["op"], "status": status,
+                    "time": started - self.start, "latency": latency, "bytes": size,
+                })
+            time.sleep(session.get("think_time", 0.0))
+
+    def worker(self, sessions: Queue):
+        """Replay queued sessions until none are left."""
+        http = requests.Session()
+        while True:
+            try:
+                session = sessions.get_nowait()
+            except Empty:
+                return
+            self.run_session(http, session)
+
+    def loop_worker(self, sessions: List[dict], offset: int, deadline: float):
+        """Replay sessions in a loop, starting at offset so workers spread over them, until the deadline."""
+        http = requests.Session()
+        for session in itertools.cycle(sessions[offset:] + sessions[:offset]):
+            if time.perf_counter() >= deadline:
+                return
+            self.run_session(http, session, deadline)
+
+
+def sample_rss(pid: int, interval: float, samples: List[dict], stop: threading.Event, start: float):
+    while not stop.wait(interval):
+        rss = process_rss_mb(pid)
+        if rss is not None:
+            samples.append({"time": time.perf_counter() - start, "rss_mb": rss})
+
+
+def start_server(port: int, log_path: Path) -> subprocess.Popen:
+    """Start main.app with uvicorn in its own process, so its memory is measured apart from the load generator."""
+    log = log_path.open("w")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=Path(__file__).resolve().parent, stdout=log, stderr=subprocess.STDOUT, env=os.environ.copy(),
+    )
+    # Loading the model takes a while, wait until the server answers
+    deadline = time.perf_counter() + 300
+    while time.perf_counter() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with {server.returncode}, see {log_path}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/metrics", timeout=1)
+            return server
+        except requests.RequestException:
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError(f"Server did not start within 300s, see {log_path}")
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+def summarize(results: List[dict], elapsed: float) -> dict:
+    by_op = defaultdict(list)
+    for result in results:
+        by_op[result["op"]].append(result)
+
+    report = {"elapsed_s": elapsed, "requests": len(results), "throughput_rps": len(results) / elapsed, "ops": {}}
+    for op, op_results in sorted(by_op.items()):
+        latencies = [r["latency"] * 1000 for r in op_results]
+        statuses = Counter(str(r["status"]) for r in op_results)
+        errors = sum(count for status, count in statuses.items() if not status.startswith("2") and status != "304")
+        report["ops"][op] = {
+            "requests": len(op_results),
+            "throughput_rps": len(op_results) / elapsed,
+            "p50_ms": statistics.median(latencies),
+            "p90_ms": percentile(latencies, 0.90),
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+            "max_ms": max(latencies),
+            "error_rate": errors / len(op_results),
+            "statuses": dict(statuses),
+        }
+        print(
+            f"{op:<12} {len(op_results):6d} req  {len(op_results) / elapsed:7.2f} req/s  p50 {report['ops'][op]['p50_ms']:8.1f}ms  "
+            f"p95 {report['ops'][op]['p95_ms']:8.1f}ms  p99 {report['ops'][op]['p99_ms']:8.1f}ms  errors {errors / len(op_results):6.1%}  {dict(statuses)}"
+        )
+    return report
+
+
+def timeline(results: List[dict], rss: List[dict], bucket: float) -> List[dict]:
+    """Throughput, p95 latency, error rate and server RSS per time bucket."""
+    buckets = defaultdict(list)
+    for result in results:
+        buckets[int(result["time"] // bucket)].append(result)
+    rss_buckets = defaultdict(list)
+    for sample in rss:
+        rss_buckets[int(sample["time"] // bucket)].append(sample["rss_mb"])
+
+    rows = []
+    for index in range(max([*buckets, *rss_buckets], default=-1) + 1):
+        bucket_results = buckets.get(index, [])
+        errors = sum(1 for r in bucket_results if not str(r["status"]).startswith("2") and r["status"] != 304)
+        rows.append({
+            "time": index * bucket,
+            "throughput_rps": len(bucket_results) / bucket,
+            "p95_ms": percentile([r["latency"] * 1000 for r in bucket_results], 0.95) if bucket_results else None,
+            "error_rate": errors / len(bucket_results) if bucket_results else None,
+            "rss_mb": max(rss_buckets[index]) if rss_buckets.get(index) else None,
+        })
+    return rows
+
+
+def plot(rows: List[dict], output: Path):
+    import matplotlib.pyplot as plt
+
+    times = [row["time"] for row in rows]
+    fig, axes = plt.subplots(4, 1, figsize=(10, 10), sharex=True)
+    for ax, key, label in zip(axes, ("throughput_rps", "p95_ms", "error_rate", "rss_mb"), ("requests/s", "p95 latency (ms)", "error rate", "server RSS (MB)")):
+        ax.plot(times, [row[key] for row in rows], marker=".")
+        ax.set_ylabel(label)
+    axes[-1].set_xlabel("time (s)")
+    fig.tight_layout()
+    fig.savefig(output)
+
+
+@app.command()
+def run(
+    sessions: Path = "loadtest/sessions.jsonl",
+    concurrency: int = 4,
+    rps: float = 0.0,
+    duration: Optional[float] = None,
+    url: Optional[str] = None,
+    pid: Optional[int] = None,
+    port: int = 8765,
+    timeout: float = 120.0,
+    sample_interval: float = 1.0,
+    output: Path = "loadtest",
+):
+    """
+    Replay sessions against a local server and report throughput, latency, errors and server RSS over time.
+
+    Without --url a server is started from main.app for the run. --concurrency sessions run at
+    once, --rps caps the request rate of all of them together, and --duration replays the
+    sessions in a loop for that many seconds instead of once.
+    """
+    output.mkdir(parents=True, exist_ok=True)
+    with sessions.open(encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    server = None
+    if url is None:
+        server = start_server(port, output / "server.log")
+        url, pid = f"http://127.0.0.1:{port}", server.pid
+
+    try:
+        queue = Queue()
+        for session in records:
+            queue.put(session)
+
+        replay = Replay(url, Pacer(rps), timeout)
+        rss_samples: List[dict] = []
+        stop = threading.Event()
+        sampler = None
+        if pid is not None:
+            sampler = threading.Thread(target=sample_rss, args=(pid, sample_interval, rss_samples, stop, replay.start), daemon=True)
+            sampler.start()
+
+        if duration is None:
+            workers = [threading.Thread(target=replay.worker, args=(queue,)) for _ in range(concurrency)]
+        else:
+            # Each worker loops over every session, so none runs out of sessions before the duration is over
+            deadline = replay.start + duration
+            workers = [
+                threading.Thread(target=replay.loop_worker, args=(records, number * len(records) // concurrency, deadline))
+                for number in range(concurrency)
+            ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - replay.start
+        stop.set()
+        if sampler is not None:
+            sampler.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = summarize(replay.results, elapsed)
+    report["config"] = {"sessions": str(sessions), "concurrency": concurrency, "rps": rps, "duration": duration, "url": url}
+    report["rss_mb"] = {
+        "start": rss_samples[0]["rss_mb"] if rss_samples else None,
+        "peak": max((s["rss_mb"] for s in rss_samples), default=None),
+        "end": rss_samples[-1]["rss_mb"] if rss_samples else None,
+    }
+    report["timeline"] = timeline(replay.results, rss_samples, max(sample_interval, 1.0))
+    print(f"total {report['requests']} requests in {elapsed:.1f}s, {report['throughput_rps']:.2f} req/s, server rss {report['rss_mb']}")
+
+    with open(output / "report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    with open(output / "requests.jsonl", "w") as f:
+        for result in replay.results:
+            f.write(json.dumps(result) + "\n")
+    plot(report["timeline"], output / "timeline.png")
+    print(f"report written to {output / 'report.json'} and {output / 'timeline.png'}")
+
+
+if __name__ == "__main__":
+    app()
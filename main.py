@@ -1,64 +1,241 @@
 
+import hmac
+import time
+from uuid import uuid4
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional
 
+import cv2
 import uvicorn
 from loguru import logger
-from fastapi import FastAPI, UploadFile, HTTPException, Form
+from fastapi import FastAPI, UploadFile, HTTPException, File, Form, Header, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 
-from models import LabelBox, PDFPageData, CompareResult, FileIdRequest
-from upload import upload_pdf
-from detect import detect_layout
-from compare import compare_layout
+from models import LabelBox, RepeatingRegion, PDFPageData, TextRect, CompareResult, FileIdRequest, DocumentRequest, LayoutEditRequest, LayoutEditResult
+from upload import DPI, render_page, save_page_image, upload_pdf
+from detect import detect_image, detect_layout, get_model
+from compare import compare_layout, save_layout_edit
 from reclassify import reclassify_layout
+from font_stats import FontStatistics, count_page_fonts
+from repeating import find_repeating_regions, in_regions
+from incremental import apply_layout_edit
+from annotate import LAYERS, OverlayCache, layer_digest, render_overlay
+from responses import negotiate
+import persist
+import metrics
+import profiling
+import raster_cache
+import page_images
+from extract import handles
+from storage import DocumentDeleted, StorageFull, storage
+from tracing import tracing
 
-# Directories to store uploaded PDFs and converted images
-UPLOAD_DIR = Path("uploads")
-IMAGES_DIR = Path("images")
-OUTPUT_DIR = Path("outputs")
-UPLOAD_DIR.mkdir(exist_ok=True)
-IMAGES_DIR.mkdir(exist_ok=True)
-OUTPUT_DIR.mkdir(exist_ok=True)
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
 
-# Serve static files from the "static" and "images" directories
+# Uploaded PDFs, page images, comparison outputs and overlays live in per-document
+# directories managed by storage.py, which also deletes them once they expire
+
+# Serve static files from the "static" directory
 app = FastAPI()
+
+# Compress large responses, preferring brotli when it is installed (it falls back to gzip itself)
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=1024)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=1024)
 app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/images", StaticFiles(directory="images"), name="images")
 
 # Store layout data and text rectangles by page
 app.state.layout_data = {}  # Stores layout rectangles detected by YOLO
 app.state.text_data = {}  # Stores text rectangles extracted from PDF by page
 app.state.scaling_factors = {}  # Stores scaling factors for each page
+app.state.page_sizes = {}  # Stores the full resolution size in pixels of each page
 app.state.comparison_results = {}  # Store comparison results
+app.state.font_statistics = {}  # Stores document-wide font statistics by file_id
+app.state.repeating_regions = {}  # Stores repeating header/footer regions by file_id and page
+app.state.traces = {}  # Stores the latest decision trace by (file_id, page_number) and stage
+
+
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    # Collect stage timings of this request for its Server-Timing header
+    timings = []
+    token = metrics.request_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.request_timings.reset(token)
+
+    elapsed = time.perf_counter() - start
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    metrics.request_seconds.observe(elapsed, path=path)
+    metrics.requests_total.inc(path=path, method=request.method, status=response.status_code)
+
+    response.headers["Server-Timing"] = metrics.server_timing(timings + [("total", elapsed)])
+    return response
+
+def input_sizes(file_id: str, page_number: int) -> dict:
+    # Sizes of the inputs of a page, stored alongside its profiles
+    sizes = {
+        # Only count text rects already extracted, profiling must not trigger an extraction
+        "text_rects": len(app.state.text_data[file_id].peek(page_number) or []) if file_id in app.state.text_data else 0,
+        "layout_rects": len(app.state.layout_data.get(file_id, {}).get(page_number, [])),
+    }
+    result = app.state.comparison_results.get((file_id, page_number))
+    if result is not None:
+        sizes["inside_rects"] = len(result["inside"])
+        sizes["outside_rects"] = len(result["outside"])
+    return sizes
+
+app.middleware("http")(profiling.profile_middleware(input_sizes))
+
+def check_profile_token(token: str):
+    if not profiling.conf.token or not hmac.compare_digest(token, profiling.conf.token):
+        raise HTTPException(status_code=403, detail="Invalid profile token")
+
+@app.get("/debug/profiles")
+def list_profiles(x_profile_token: str = Header(default="")):
+    check_profile_token(x_profile_token)
+    return profiling.list_profiles()
+
+@app.get("/debug/profiles/{profile_id}")
+def download_profile(profile_id: str, x_profile_token: str = Header(default="")):
+    check_profile_token(x_profile_token)
+    path = profiling.profile_path(profile_id)
+    if path is None or not path.exists():
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, filename=path.name)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def forget_documents(file_ids: List[str]):
+    # Called before the storage sweeper deletes the files of documents, once per sweep
+    persist.flush()
+    for file_id in file_ids:
+        document_text = app.state.text_data.get(file_id)
+        if document_text is not None:
+            document_text.cancel_prefetch()
+        for state in (app.state.layout_data, app.state.text_data, app.state.font_statistics, app.state.repeating_regions):
+            state.pop(file_id, None)
+        for state in (app.state.scaling_factors, app.state.page_sizes, app.state.comparison_results, app.state.traces):
+            for key in [key for key in list(state) if key[0] == file_id]:
+                state.pop(key, None)
+        raster_cache.cache.discard(file_id)
+        overlays.discard(file_id)
+        handles.close(storage.path("uploads", file_id) / f"{file_id}.pdf")
+
+storage.on_delete(forget_documents)
 
+@app.exception_handler(DocumentDeleted)
+def document_deleted(request: Request, e: DocumentDeleted):
+    # A request racing the sweeper sees the document as already gone
+    return JSONResponse(status_code=404, content={"detail": "Document not found"})
+
+@app.on_event("startup")
+def startup():
+    get_model()
+    storage.start()
+
+@app.on_event("shutdown")
+def shutdown():
+    storage.stop()
+    # Make sure queued comparison outputs reach the disk
+    persist.flush()
 
 @app.post("/upload-pdf/", response_model=List[PDFPageData])
-async def upload(file: UploadFile):
+def upload(request: Request, file: UploadFile, include_text: bool = True, render_images: bool = True):
+    try:
+        storage.ensure_space()
+    except StorageFull as e:
+        raise HTTPException(status_code=507, detail=str(e))
+
     # Call the upload logic function and get all necessary data
-    file_id, page_data, app.state.text_data, app.state.scaling_factors = upload_pdf(file, UPLOAD_DIR, IMAGES_DIR)
-    return page_data
+    # Clients can fetch text rects per page from /text instead of in one large response,
+    # in which case no page is extracted until something reads it
+    file_id = str(uuid4())
+    file_id, page_data, text_data, scaling_factors = upload_pdf(
+        file, storage.document_dir("uploads", file_id), storage.document_dir("images", file_id),
+        render_images=render_images, extract_text=include_text, file_id=file_id,
+    )
+    app.state.text_data.update(text_data)
+    app.state.scaling_factors.update(scaling_factors)
+    app.state.page_sizes.update({(file_id, page.page_number): (page.width, page.height) for page in page_data})
 
-@app.post("/api/detect", response_model=List[LabelBox])
-def detect(image: UploadFile = Form(...), file_id: str = Form(...), page_number: int = Form(...)):
-    logger.info(f"Received image for detection: {image.filename} with file_id: {file_id} and page_number: {page_number}")
+    return negotiate(request, page_data)
+
+@app.get("/text/{file_id}/{page_number}", response_model=List[TextRect])
+def text(request: Request, file_id: str, page_number: int, clip: Optional[str] = None):
+    # clip=x0,y0,x1,y1 (PDF coordinates) returns only the text rects in that region
+    if storage.is_deleting(file_id) or page_number not in app.state.text_data.get(file_id, {}):
+        raise HTTPException(status_code=404, detail="Page not found")
+    storage.touch(file_id)
+
+    if clip is None:
+        return negotiate(request, app.state.text_data[file_id][page_number], TextRect)
 
-    image_data = image.file.read()
-    label_boxes = detect_layout(image_data)
+    try:
+        clip_box = [float(v) for v in clip.split(",")]
+    except ValueError:
+        clip_box = []
+    if len(clip_box) != 4:
+        raise HTTPException(status_code=400, detail="clip must be x0,y0,x1,y1")
+    return negotiate(request, app.state.text_data[file_id].clipped(page_number, clip_box), TextRect)
+
+def page_raster(file_id: str, page_number: int):
+    # Pages rendered at upload are kept decoded in the raster cache; on a miss read the JPEG or render the PDF
+    cached = raster_cache.cache.get(file_id, page_number)
+    if cached is not None:
+        return cached
+
+    image_path = page_images.image_path(storage.document_dir("images", file_id), file_id, page_number)
+    if image_path.exists():
+        logger.info(f"Raster cache miss, decoding {image_path}")
+        image = cv2.imread(str(image_path), cv2.IMREAD_COLOR)
+    else:
+        logger.info(f"Raster cache miss, rendering page for detection with file_id: {file_id} and page_number: {page_number}")
+        image = render_page(storage.document_dir("uploads", file_id) / f"{file_id}.pdf", page_number, DPI)
+
+    return raster_cache.cache_page(file_id, page_number, image)
+
+@app.post("/api/detect", response_model=List[LabelBox])
+@profiling.profiled
+def detect(request: Request, image: Optional[UploadFile] = File(None), file_id: str = Form(...), page_number: int = Form(...)):
+    if image is not None:
+        logger.info(f"Received image for detection: {image.filename} with file_id: {file_id} and page_number: {page_number}")
+        label_boxes = detect_layout(image.file.read())
+    else:
+        if storage.is_deleting(file_id) or (file_id, page_number) not in app.state.scaling_factors:
+            raise HTTPException(status_code=404, detail="Page not found")
+        label_boxes = detect_image(*page_raster(file_id, page_number))
 
     if not label_boxes:
         raise HTTPException(status_code=400, detail="Detection failed")
+    storage.touch(file_id)
+
+    # Add repeating header/footer regions already found for this document but missed on this page
+    for region in app.state.repeating_regions.get(file_id, {}).get(page_number, []):
+        if not any(box.label == region.label and in_regions(box.box, [region.box]) for box in label_boxes):
+            label_boxes.append(LabelBox(label=region.label, box=region.box, confidence=region.confidence))
 
     if file_id not in app.state.layout_data:
         app.state.layout_data[file_id] = {}
 
     app.state.layout_data[file_id][page_number] = label_boxes  # Store detected layout rectangles by page
     logger.info(f"Layout data stored for file_id: {file_id} and page_number: {page_number}")
-    return label_boxes
+    return negotiate(request, label_boxes, LabelBox)
 
 @app.post("/compare", response_model=CompareResult)
-def compare(request: FileIdRequest):
+@profiling.profiled
+def compare(request: FileIdRequest, http_request: Request, trace: bool = False):
     file_id = request.file_id
     page_number = request.page_number
     logger.info(f"Received file_id for comparison: {file_id} and page_number: {page_number}")
@@ -67,28 +244,156 @@ def compare(request: FileIdRequest):
         logger.error(f"File ID {file_id} not found in layout_data or text_data.")
         raise HTTPException(status_code=400, detail="No layout or text data available for this file.")
 
-    result = compare_layout(file_id, page_number, app.state.layout_data, app.state.text_data, app.state.scaling_factors, OUTPUT_DIR)
+    masked_regions = app.state.repeating_regions.get(file_id, {}).get(page_number, [])
+    with tracing(trace) as page_trace:
+        result = compare_layout(file_id, page_number, app.state.layout_data, app.state.text_data, app.state.scaling_factors, storage.document_dir("outputs", file_id), masked_regions)
+    if page_trace is not None:
+        app.state.traces[(file_id, page_number, "compare")] = page_trace.to_list()
     app.state.comparison_results[(file_id, page_number)] = result
+    font_statistics = app.state.font_statistics.setdefault(file_id, FontStatistics())
+    font_statistics.replace_page(page_number, count_page_fonts(result["index"]))
 
-    return CompareResult(inside=result["inside"], outside=result["outside"])
+    return negotiate(http_request, CompareResult(inside=result["inside"], outside=result["outside"]))
 
-@app.post("/reclassify", response_model=List[LabelBox])
-def reclassify(request: FileIdRequest):
+@app.post("/layout/edit", response_model=LayoutEditResult)
+@profiling.profiled
+def edit_layout(request: LayoutEditRequest):
     file_id = request.file_id
     page_number = request.page_number
+    logger.info(f"Received layout edit {request.op} for file_id: {file_id} and page_number: {page_number}")
 
+    result = app.state.comparison_results.get((file_id, page_number))
+    if result is None:
+        raise HTTPException(status_code=400, detail="Compare this page before editing its layout.")
+
+    page_index = result["index"]
+    storage.touch(file_id)
+    if request.op in ("remove", "move") and not (request.index is not None and 0 <= request.index < len(page_index.layout_rects)):
+        raise HTTPException(status_code=400, detail="A valid index is required for remove and move.")
+    if request.op in ("add", "move") and request.label_box is None:
+        raise HTTPException(status_code=400, detail="A label_box is required for add and move.")
+
+    # Only the text rects near the edited layout rect are revisited
+    changed, neighbours = apply_layout_edit(page_index, request.op, request.index, request.label_box)
+    app.state.layout_data[file_id][page_number] = list(page_index.layout_rects)
+    app.state.font_statistics[file_id].replace_page(page_number, count_page_fonts(page_index))
+
+    # Only the text rects that changed state are returned and persisted; the comparison splits
+    # its inside/outside lists again when /compare, /overlay or /reclassify next read them
+    delta = page_index.delta(changed)
+    if changed:
+        save_layout_edit(file_id, page_number, delta, storage.document_dir("outputs", file_id))
+
+    return LayoutEditResult(
+        layout=page_index.layout_rects,
+        inside=[rect for _, rect in delta["inside"]],
+        outside=[rect for _, rect in delta["outside"]],
+        positions=[i for i, _ in delta["inside"] + delta["outside"]],
+        changed=len(changed),
+        neighbours=sorted(neighbours),
+    )
+
+def reclassified_layout(file_id: str, page_number: int) -> List[LabelBox]:
+    storage.touch(file_id)
     # Call the reclassify function from reclassify.py
-    label_boxes = reclassify_layout(file_id, page_number, app.state.comparison_results, app.state.layout_data)
+    masked_regions = app.state.repeating_regions.get(file_id, {}).get(page_number, [])
+    font_statistics = app.state.font_statistics.get(file_id)
+    font_labels = font_statistics.labels() if font_statistics is not None else None
+    return reclassify_layout(file_id, page_number, app.state.comparison_results, app.state.layout_data, masked_regions, font_labels)
+
+@app.post("/reclassify", response_model=List[LabelBox])
+@profiling.profiled
+def reclassify(request: FileIdRequest, http_request: Request, trace: bool = False):
+    file_id = request.file_id
+    page_number = request.page_number
 
-    return label_boxes
+    with tracing(trace) as page_trace:
+        label_boxes = reclassified_layout(file_id, page_number)
+    if page_trace is not None:
+        app.state.traces[(file_id, page_number, "reclassify")] = page_trace.to_list()
+
+    return negotiate(http_request, label_boxes, LabelBox)
+
+@app.post("/repeating", response_model=Dict[int, List[RepeatingRegion]])
+@profiling.profiled
+def repeating(request: DocumentRequest):
+    file_id = request.file_id
+    logger.info(f"Received file_id for repeating header/footer detection: {file_id}")
+
+    if file_id not in app.state.layout_data or file_id not in app.state.text_data:
+        logger.error(f"File ID {file_id} not found in layout_data or text_data.")
+        raise HTTPException(status_code=400, detail="No layout or text data available for this file.")
+
+    storage.touch(file_id)
+    # Detect repeating regions once per document and propagate them to every page
+    regions = find_repeating_regions(file_id, app.state.layout_data, app.state.text_data, app.state.scaling_factors)
+    app.state.repeating_regions[file_id] = regions
+
+    return regions
+
+@app.get("/trace/{file_id}/{page_number}/{stage}")
+def get_trace(file_id: str, page_number: int, stage: str):
+    # Traces are recorded by calling /compare or /reclassify with ?trace=true
+    events = app.state.traces.get((file_id, page_number, stage))
+    if events is None:
+        raise HTTPException(status_code=404, detail="No trace recorded for this page and stage")
+    return events
 
 @app.get("/get-image/{file_id}/{page_number}")
-async def get_image(file_id: str, page_number: int):
-    image_path = Path(IMAGES_DIR) / f"{file_id}_page_{page_number}.jpeg"
-    if not image_path.exists():
+def get_image(file_id: str, page_number: int, size: str = "full", if_none_match: Optional[str] = Header(None)):
+    # size picks thumbnail, screen or full; each is generated once and then served from disk
+    if size not in page_images.SIZES:
+        raise HTTPException(status_code=400, detail=f"Unknown size {size}, expected one of {', '.join(page_images.SIZES)}")
+    if storage.is_deleting(file_id) or (file_id, page_number) not in app.state.scaling_factors:
         raise HTTPException(status_code=404, detail="Page not found")
 
-    return FileResponse(image_path)
+    def render_full(image_path: Path):
+        # Pages uploaded with render_images=false get their display JPEG on first request
+        with metrics.timer("upload_render"):
+            image = render_page(storage.document_dir("uploads", file_id) / f"{file_id}.pdf", page_number, DPI)
+        save_page_image(image, image_path)
+
+    image_path = page_images.ensure_image(storage.document_dir("images", file_id), file_id, page_number, size, render_full)
+    return page_images.image_response(image_path, if_none_match)
+
+overlays = OverlayCache(lambda file_id: storage.document_dir("overlays", file_id))
+
+@app.get("/overlay/{file_id}/{page_number}/{layer}")
+def overlay(file_id: str, page_number: int, layer: str, if_none_match: Optional[str] = Header(None)):
+    # Layers are drawn server-side into a transparent PNG instead of one DOM element per rect
+    if layer not in LAYERS:
+        raise HTTPException(status_code=404, detail=f"Unknown layer, expected one of {', '.join(LAYERS)}")
+    if storage.is_deleting(file_id) or (file_id, page_number) not in app.state.page_sizes:
+        raise HTTPException(status_code=404, detail="Page not found")
+
+    label_boxes, inside, outside = [], [], []
+    if layer == "detect":
+        if page_number not in app.state.layout_data.get(file_id, {}):
+            raise HTTPException(status_code=404, detail="Detect this page first.")
+        label_boxes = app.state.layout_data[file_id][page_number]
+    else:
+        result = app.state.comparison_results.get((file_id, page_number))
+        if result is None:
+            raise HTTPException(status_code=404, detail="Compare this page first.")
+        if layer == "compare":
+            inside, outside = result["inside"], result["outside"]
+        else:
+            label_boxes = reclassified_layout(file_id, page_number)
+
+    storage.touch(file_id)
+    digest = layer_digest(layer, label_boxes, inside, outside)
+    headers = {"ETag": f'"{digest}"', "Cache-Control": "no-cache"}
+    if page_images.not_modified(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    path = overlays.get(file_id, page_number, layer, digest)
+    if path is None:
+        # Overlays match the inference raster, the browser scales them with the page image;
+        # its size follows from the page size, so no page is decoded or rendered to draw one
+        size, scale = raster_cache.inference_size(*app.state.page_sizes[(file_id, page_number)])
+        path = overlays.put(file_id, page_number, layer, digest, render_overlay(size, scale, layer, label_boxes, inside, outside))
+
+    return FileResponse(path, media_type="image/png", headers=headers)
 
 # Serve the index.html file
 @app.get("/", response_class=FileResponse)
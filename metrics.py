@@ -0,0 +1,122 @@
+# metrics.py
+import bisect
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+# Histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Stage timings of the current request, reported in its Server-Timing header
+request_timings: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar("request_timings", default=None)
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+class Metric:
+    def __init__(self, name: str, description: str, kind: str):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description, "counter")
+        self.values: Dict[Tuple, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] += amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            return self.header() + [f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items()]
+
+class Gauge(Counter):
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self.kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = BUCKETS):
+        super().__init__(name, description, "histogram")
+        self.buckets = buckets
+        self.counts: Dict[Tuple, List[int]] = {}
+        self.sums: Dict[Tuple, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[key] += value
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        with self.lock:
+            for key, counts in self.counts.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{self.name}_bucket{format_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {self.sums[key]}")
+                lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+stage_seconds = Histogram("doclaynet_stage_seconds", "Time spent in each pipeline stage.")
+request_seconds = Histogram("doclaynet_request_seconds", "Time spent handling each request.")
+requests_total = Counter("doclaynet_requests_total", "Requests handled by path and status.")
+pages_total = Counter("doclaynet_pages_total", "Pages uploaded.")
+detections_total = Counter("doclaynet_detections_total", "Layout rects detected by label.")
+
+REGISTRY: List[Metric] = [stage_seconds, request_seconds, requests_total, pages_total, detections_total]
+
+def register(metric: Metric) -> Metric:
+    REGISTRY.append(metric)
+    return metric
+
+def observe_stage(stage: str, seconds: float):
+    """Record a stage duration in the histogram and in the current request's timings."""
+    stage_seconds.observe(seconds, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+@contextmanager
+def timer(stage: str):
+    """Time the enclosed block as one pipeline stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def server_timing(timings: List[Tuple[str, float]]) -> str:
+    """Format stage timings as a Server-Timing header, summing repeated stages."""
+    totals: Dict[str, float] = defaultdict(float)
+    for stage, seconds in timings:
+        totals[stage] += seconds
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items())
+
+def render() -> str:
+    """Render every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
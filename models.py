@@ -1,7 +1,7 @@
 # models.py
 from enum import Enum
 from pydantic import BaseModel, Field
-from typing import List
+from typing import List, Literal, Optional
 
 class LayoutLabels(Enum):
     Picture = "Picture"
@@ -22,6 +22,10 @@ class LabelBox(BaseModel):
     box: list[float] = Field(
         example=[0.0, 0.0, 0.0, 0.0], description="Bounding box coordinates"
     )
+    confidence: float = Field(default=1.0, example=0.9, description="Detection confidence of the object")
+
+class RepeatingRegion(LabelBox):
+    page_ratio: float = Field(default=1.0, example=0.9, description="Fraction of the document pages the region was detected on")
 
 class TextRect(BaseModel):
     box: list[float] = Field(
@@ -34,7 +38,9 @@ class TextRect(BaseModel):
 class PDFPageData(BaseModel):
     page_number: int
     image_url: str
-    text_rects: List[TextRect]
+    width: int = Field(default=0, description="Width in pixels of the full size page image")
+    height: int = Field(default=0, description="Height in pixels of the full size page image")
+    text_rects: List[TextRect] = Field(default=[], description="Text rects of the page, empty when omitted from the upload response")
 
 class CompareResult(BaseModel):
     inside: list[TextRect]
@@ -43,6 +49,24 @@ class CompareResult(BaseModel):
 class ReclassifyResult(BaseModel):
     reclassified: list[LabelBox]
 
+class DocumentRequest(BaseModel):
+    file_id: str
+
 class FileIdRequest(BaseModel):
     file_id: str
     page_number: int  # Include page_number in the request to compare specific pages
+
+class LayoutEditRequest(BaseModel):
+    file_id: str
+    page_number: int
+    op: Literal["add", "remove", "move"] = Field(description="Edit operation on the page layout")
+    index: Optional[int] = Field(default=None, description="Position of the edited layout rect, for remove and move")
+    label_box: Optional[LabelBox] = Field(default=None, description="New layout rect, for add and move")
+
+class LayoutEditResult(BaseModel):
+    layout: list[LabelBox]
+    inside: list[TextRect] = Field(description="Text rects the edit moved inside")
+    outside: list[TextRect] = Field(description="Text rects the edit moved outside")
+    positions: list[int] = Field(description="Positions in the page text rects of the moved inside, then outside, text rects")
+    changed: int = Field(description="Number of text rects whose inside/outside state changed")
+    neighbours: list[int] = Field(description="Positions of the neighbouring layout rects affected by the edit")
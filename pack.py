@@ -0,0 +1,98 @@
+import json
+from pathlib import Path
+from typing import List
+
+import cv2
+import numpy as np
+import tqdm
+import typer
+import yaml
+
+# Padding value used by ultralytics when letterboxing
+PAD_VALUE = 114
+
+
+def letterbox(image: np.ndarray, imgsz: int):
+    """Resize image to fit in an imgsz square and pad it, returning the ratio and padding used."""
+    height, width = image.shape[:2]
+    ratio = imgsz / max(height, width)
+    new_width, new_height = round(width * ratio), round(height * ratio)
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+
+    pad_x = (imgsz - new_width) // 2
+    pad_y = (imgsz - new_height) // 2
+    canvas = np.full((imgsz, imgsz, 3), PAD_VALUE, dtype=np.uint8)
+    canvas[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = image
+    return canvas, ratio, pad_x, pad_y
+
+
+def read_labels(label_path: Path, width: int, height: int, ratio: float, pad_x: int, pad_y: int, imgsz: int) -> np.ndarray:
+    """Read YOLO labels and move them into the letterboxed image frame."""
+    if not label_path.exists():
+        return np.zeros((0, 5), dtype=np.float32)
+
+    labels = np.loadtxt(label_path, dtype=np.float32, ndmin=2)
+    labels[:, 1] = (labels[:, 1] * width * ratio + pad_x) / imgsz
+    labels[:, 2] = (labels[:, 2] * height * ratio + pad_y) / imgsz
+    labels[:, 3] = labels[:, 3] * width * ratio / imgsz
+    labels[:, 4] = labels[:, 4] * height * ratio / imgsz
+    return labels
+
+
+def pack_split(datasets: Path, output: Path, split: str, imgsz: int, shard_size: int):
+    image_paths = sorted((datasets / "images" / split).glob("*.png"))
+    split_dir = output / split
+    split_dir.mkdir(parents=True, exist_ok=True)
+
+    shards = []
+    labels = []
+    for shard_index, start in enumerate(range(0, len(image_paths), shard_size)):
+        shard_paths = image_paths[start:start + shard_size]
+        shard_file = f"shard_{shard_index:05d}.npy"
+        shard = np.lib.format.open_memmap(
+            split_dir / shard_file, mode="w+", dtype=np.uint8, shape=(len(shard_paths), imgsz, imgsz, 3)
+        )
+        for offset, image_path in enumerate(tqdm.tqdm(shard_paths, desc=f"pack {split} {shard_file}...")):
+            image = cv2.imread(str(image_path), cv2.IMREAD_COLOR)
+            height, width = image.shape[:2]
+            shard[offset], ratio, pad_x, pad_y = letterbox(image, imgsz)
+
+            image_labels = read_labels(
+                datasets / "labels" / split / f"{image_path.stem}.txt", width, height, ratio, pad_x, pad_y, imgsz
+            )
+            index_column = np.full((len(image_labels), 1), start + offset, dtype=np.float32)
+            labels.append(np.hstack([index_column, image_labels]))
+        shard.flush()
+        del shard
+        shards.append({"file": shard_file, "count": len(shard_paths)})
+
+    # Labels of the whole split in one array of [image index, class, x, y, w, h]
+    np.save(split_dir / "labels.npy", np.concatenate(labels) if labels else np.zeros((0, 6), dtype=np.float32))
+    with open(split_dir / "index.json", "w") as f:
+        json.dump({"imgsz": imgsz, "shards": shards, "files": [path.stem for path in image_paths]}, f)
+
+
+def main(
+    datasets: Path = "./datasets",
+    output: Path = None,
+    imgsz: int = 1024,
+    shard_size: int = 2048,
+    splits: List[str] = ["train", "val", "test"],
+):
+    output = output or datasets / f"packed-{imgsz}"
+    output.mkdir(parents=True, exist_ok=True)
+
+    with open(datasets / "data.yaml") as f:
+        data = yaml.safe_load(f)
+
+    for split in splits:
+        pack_split(datasets, output, split, imgsz, shard_size)
+
+    with open(output / "data.yaml", "w") as f:
+        yaml.dump({"path": str(output.resolve()), "train": "train", "val": "val", "test": "test", "names": data["names"]}, f)
+    print(f"packed dataset written to {output}, train with: python train.py {{base-model}} --datasets {output / 'data.yaml'} --packed")
+
+
+if __name__ == "__main__":
+    typer.run(main)
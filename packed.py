@@ -0,0 +1,130 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import typer
+import yaml
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer, DetectionValidator
+from ultralytics.utils import colorstr
+from ultralytics.utils.torch_utils import de_parallel
+
+
+class PackedSplit:
+    """Read-only view of a split packed by pack.py, backed by memory-mapped shards."""
+
+    def __init__(self, split_dir: Path):
+        self.split_dir = Path(split_dir)
+        with open(self.split_dir / "index.json") as f:
+            index = json.load(f)
+        self.imgsz = index["imgsz"]
+        self.files = index["files"]
+        self.shard_files = [shard["file"] for shard in index["shards"]]
+        self.offsets = np.cumsum([0] + [shard["count"] for shard in index["shards"]])
+        self.shards = None
+
+    def __getstate__(self):
+        # Dataloader workers map the shards themselves instead of receiving pickled copies
+        state = self.__dict__.copy()
+        state["shards"] = None
+        return state
+
+    def image(self, i: int) -> np.ndarray:
+        if self.shards is None:
+            # Copy-on-write keeps reads zero-copy while letting in-place augmentations work
+            self.shards = [np.load(self.split_dir / file, mmap_mode="c") for file in self.shard_files]
+        shard_index = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        return self.shards[shard_index][i - self.offsets[shard_index]]
+
+    def labels(self, im_files: list) -> list:
+        packed = np.load(self.split_dir / "labels.npy")
+        by_image = np.split(packed[:, 1:], np.searchsorted(packed[:, 0], np.arange(1, len(self.files))))
+        return [
+            {
+                "im_file": im_file,
+                "shape": (self.imgsz, self.imgsz),
+                "cls": image_labels[:, :1].astype(np.float32),
+                "bboxes": image_labels[:, 1:].astype(np.float32),
+                "segments": [],
+                "keypoints": None,
+                "normalized": True,
+                "bbox_format": "xywh",
+            }
+            for im_file, image_labels in zip(im_files, by_image)
+        ]
+
+
+class PackedDataset(YOLODataset):
+    """YOLODataset reading pre-letterboxed images and labels from a packed split."""
+
+    def get_img_files(self, img_path):
+        self.packed = PackedSplit(img_path)
+        return [str(Path(img_path) / f"{stem}.png") for stem in self.packed.files]
+
+    def get_labels(self):
+        return self.packed.labels(self.im_files)
+
+    def load_image(self, i, rect_mode=True, **kwargs):
+        image = self.packed.image(i)
+        if self.augment:
+            # Mosaic draws its other images from the buffer, so keep it as ultralytics does;
+            # the images themselves stay in the memory map instead of self.ims
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+        return image, image.shape[:2], image.shape[:2]
+
+
+def build_packed_dataset(cfg, img_path, batch, data, mode="train", rect=False, stride=32):
+    """Build a PackedDataset with the same arguments ultralytics' build_yolo_dataset uses."""
+    return PackedDataset(
+        img_path=img_path,
+        imgsz=cfg.imgsz,
+        batch_size=batch,
+        augment=mode == "train",
+        hyp=cfg,
+        rect=cfg.rect or rect,
+        cache=None,
+        single_cls=cfg.single_cls or False,
+        stride=int(stride),
+        pad=0.0 if mode == "train" else 0.5,
+        prefix=colorstr(f"{mode}: "),
+        task=cfg.task,
+        classes=cfg.classes,
+        data=data,
+        fraction=cfg.fraction if mode == "train" else 1.0,
+    )
+
+
+class PackedTrainer(DetectionTrainer):
+    def build_dataset(self, img_path, mode="train", batch=None):
+        gs = max(int(de_parallel(self.model).stride.max() if self.model else 0), 32)
+        return build_packed_dataset(self.args, img_path, batch, self.data, mode=mode, rect=mode == "val", stride=gs)
+
+
+class PackedValidator(DetectionValidator):
+    def build_dataset(self, img_path, mode="val", batch=None):
+        return build_packed_dataset(self.args, img_path, batch, self.data, mode=mode, stride=self.stride)
+
+
+def main(data: Path, split: str = "train", batch: int = 4, mosaic: float = 1.0):
+    """Build one augmented batch from a packed split, to check it loads before a long training run."""
+    from ultralytics.cfg import get_cfg
+
+    with open(data) as f:
+        data_yaml = yaml.safe_load(f)
+    names = data_yaml["names"]
+    if isinstance(names, list):
+        names = dict(enumerate(names))
+    split_dir = Path(data_yaml["path"]) / data_yaml[split]
+
+    imgsz = PackedSplit(split_dir).imgsz
+    cfg = get_cfg(overrides={"task": "detect", "mode": "train", "imgsz": imgsz, "mosaic": mosaic})
+    dataset = build_packed_dataset(cfg, split_dir, batch, {"names": names, "nc": len(names), "channels": 3}, mode="train")
+    samples = [dataset[i % len(dataset)] for i in range(batch)]
+    batch_data = PackedDataset.collate_fn(samples)
+    print(f"built a batch of images {tuple(batch_data['img'].shape)} with {len(batch_data['cls'])} boxes from {split_dir}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
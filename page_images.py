@@ -0,0 +1,120 @@
+# page_images.py
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import cv2
+import numpy as np
+from fastapi.responses import FileResponse, Response
+from loguru import logger
+
+from metrics import Counter, register, timer
+import raster_cache
+
+# Longest side in pixels of each served size, None keeps the full render
+SIZES: Dict[str, Optional[int]] = {
+    "thumbnail": 256,
+    "screen": 1600,
+    "full": None,
+}
+JPEG_QUALITY = 85
+# A page image never changes once written, so clients may keep it as long as they like
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+image_requests = register(Counter("doclaynet_image_requests_total", "Page image requests by size and result."))
+
+generation_locks: Dict[Path, threading.Lock] = {}
+generation_locks_lock = threading.Lock()
+
+def image_path(images_dir: Path, file_id: str, page_number: int, size: str = "full") -> Path:
+    if size == "full":
+        return images_dir / f"{file_id}_page_{page_number}.jpeg"
+    return images_dir / f"{file_id}_page_{page_number}_{size}.jpeg"
+
+def file_etag(path: Path) -> str:
+    """Strong ETag of an image file, valid because page images are written once and replaced atomically."""
+    stat = path.stat()
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+def not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header matches etag, using the weak comparison RFC 9110 requires."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def write_jpeg(image: np.ndarray, path: Path, quality: int = JPEG_QUALITY):
+    # Progressive JPEGs show a coarse page while the rest is still downloading
+    ok, buffer = cv2.imencode(".jpeg", image, [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_PROGRESSIVE, 1])
+    if not ok:
+        raise ValueError(f"Failed to encode {path}")
+    tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(buffer.tobytes())
+    tmp_path.replace(path)
+
+def resize_longest(image: np.ndarray, max_side: int) -> np.ndarray:
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1.0:
+        return image
+    return cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+def ensure_image(images_dir: Path, file_id: str, page_number: int, size: str, render_full: Callable[[Path], None]) -> Path:
+    """
+    Return the path of a page image at size, generating it on first request.
+
+    Args:
+        images_dir: Directory holding the page images.
+        file_id: The document of the page.
+        page_number: The page.
+        size: One of SIZES.
+        render_full: Writes the full size JPEG to the given path, called when it doesn't exist yet.
+
+    Returns:
+        The path of the JPEG.
+    """
+    path = image_path(images_dir, file_id, page_number, size)
+    if path.exists():
+        image_requests.inc(size=size, result="hit")
+        return path
+
+    # One request generates an image while concurrent requests for it wait
+    with generation_locks_lock:
+        lock = generation_locks.setdefault(path, threading.Lock())
+    with lock:
+        if not path.exists():
+            image_requests.inc(size=size, result="miss")
+            full_path = image_path(images_dir, file_id, page_number)
+            if size == "full":
+                render_full(full_path)
+            else:
+                max_side = SIZES[size]
+                # Downscale the cached inference raster when it is large enough, otherwise the full JPEG
+                cached = raster_cache.cache.get(file_id, page_number)
+                if cached is not None and max(cached[0].shape[:2]) >= max_side:
+                    source = cached[0]
+                else:
+                    if not full_path.exists():
+                        render_full(full_path)
+                    source = cv2.imread(str(full_path), cv2.IMREAD_COLOR)
+                with timer("image_resize"):
+                    write_jpeg(resize_longest(source, max_side), path)
+                logger.info(f"Generated {size} image {path}")
+        else:
+            image_requests.inc(size=size, result="hit")
+    with generation_locks_lock:
+        generation_locks.pop(path, None)
+    return path
+
+def image_response(path: Path, if_none_match: Optional[str]) -> Response:
+    """
+    Serve a page image with a strong ETag and long-lived caching.
+
+    Conditional requests get a 304. Range requests are answered by FileResponse, which
+    supports them in current Starlette releases.
+    """
+    headers = {"ETag": file_etag(path), "Cache-Control": CACHE_CONTROL}
+    if not_modified(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
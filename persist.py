@@ -0,0 +1,175 @@
+# persist.py
+import json
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from loguru import logger
+
+from models import TextRect
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Comparison output persistence configuration
+class PersistConfig:
+    # "off" skips writing, "sync" writes on the request path, "background" hands writes to a worker thread
+    mode: str = "sync"
+    # "json" writes pretty-printed _inside/_outside files per page, "orjson" writes them compactly,
+    # "msgpack" writes one file per page and "jsonl" appends every page to one file per document.
+    # Layout edits are appended to a _edits.jsonl file per page in every format, holding the text
+    # rects whose state changed with their positions; writing the whole page again removes it
+    format: str = "json"
+    # Number of queued pages written per batch and the longest a queued page waits
+    batch_size: int = 32
+    flush_interval: float = 1.0
+
+conf = PersistConfig()
+
+# Output dir, file_id, page_number, inside and outside text rects, and whether they are an edit
+Record = Tuple[Path, str, int, List, List, bool]
+
+def write_json(output_dir: Path, file_id: str, page_number: int, inside: List[dict], outside: List[dict]):
+    for kind, rects in (("inside", inside), ("outside", outside)):
+        with (output_dir / f"{file_id}_page_{page_number}_{kind}.json").open("w", encoding="utf-8") as f:
+            json.dump(rects, f, ensure_ascii=False, indent=4)
+
+def write_orjson(output_dir: Path, file_id: str, page_number: int, inside: List[dict], outside: List[dict]):
+    for kind, rects in (("inside", inside), ("outside", outside)):
+        (output_dir / f"{file_id}_page_{page_number}_{kind}.json").write_bytes(orjson.dumps(rects))
+
+def write_msgpack(output_dir: Path, file_id: str, page_number: int, inside: List[dict], outside: List[dict]):
+    data = msgpack.packb({"inside": inside, "outside": outside}, use_bin_type=True)
+    (output_dir / f"{file_id}_page_{page_number}.msgpack").write_bytes(data)
+
+def write_jsonl(output_dir: Path, file_id: str, page_number: int, inside: List[dict], outside: List[dict]):
+    # Later lines for the same page supersede earlier ones when the page is compared again
+    line = json.dumps({"page_number": page_number, "inside": inside, "outside": outside}, ensure_ascii=False)
+    with (output_dir / f"{file_id}.jsonl").open("a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+def edits_path(output_dir: Path, file_id: str, page_number: int) -> Path:
+    return output_dir / f"{file_id}_page_{page_number}_edits.jsonl"
+
+def write_edit(output_dir: Path, file_id: str, page_number: int, inside: List[dict], outside: List[dict]):
+    # Replaying the lines in order over the last full output gives the current state of the page
+    line = json.dumps({"inside": inside, "outside": outside}, ensure_ascii=False)
+    with edits_path(output_dir, file_id, page_number).open("a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+WRITERS = {
+    "json": write_json,
+    "orjson": write_orjson,
+    "msgpack": write_msgpack,
+    "jsonl": write_jsonl,
+}
+
+MODES = ("off", "sync", "background")
+
+def resolve_writer(mode: str, format: str) -> Callable:
+    """Check the configuration once at import, returning the writer of format or json when its serializer is missing."""
+    if mode not in MODES:
+        raise ValueError(f"Unknown persist mode {mode!r}, expected one of {', '.join(MODES)}")
+    if format not in WRITERS:
+        raise ValueError(f"Unknown persist format {format!r}, expected one of {', '.join(WRITERS)}")
+    if format == "orjson" and orjson is None or format == "msgpack" and msgpack is None:
+        logger.warning(f"{format} is not installed, falling back to json output.")
+        return write_json
+    return WRITERS[format]
+
+writer = resolve_writer(conf.mode, conf.format)
+
+def write_records(records: List[Record]):
+    for output_dir, file_id, page_number, inside, outside, is_edit in records:
+        try:
+            if is_edit:
+                write_edit(output_dir, file_id, page_number, [{"index": i, **rect.dict()} for i, rect in inside], [{"index": i, **rect.dict()} for i, rect in outside])
+                continue
+            writer(output_dir, file_id, page_number, [rect.dict() for rect in inside], [rect.dict() for rect in outside])
+            # The full output supersedes the edits made before it
+            edits_path(output_dir, file_id, page_number).unlink(missing_ok=True)
+        except OSError as e:
+            logger.error(f"Failed to write comparison for file_id {file_id}, page_number {page_number}: {e}")
+
+class BackgroundWriter:
+    """Write queued comparison outputs in batches on a daemon thread."""
+
+    def __init__(self):
+        self.queue: "queue.Queue[Record]" = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="persist-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, record: Record):
+        self.queue.put(record)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + conf.flush_interval
+            while len(batch) < conf.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            # Only the latest comparison of a page in the batch needs writing, after the edits
+            # queued before it; every edit is a delta and is kept
+            latest: Dict[Tuple, Record] = {}
+            for position, record in enumerate(batch):
+                key = (record[0], record[1], record[2], position if record[5] else None)
+                latest.pop(key, None)
+                latest[key] = record
+            try:
+                write_records(list(latest.values()))
+            except Exception:
+                # Losing a batch is better than losing the thread, which would make flush() hang
+                logger.exception(f"Failed to write a batch of {len(latest)} comparisons")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+background_writer = None
+background_lock = threading.Lock()
+
+def save_comparison(output_dir: Path, file_id: str, page_number: int, inside: List[TextRect], outside: List[TextRect]):
+    """Persist the inside and outside text rects of a page according to PersistConfig."""
+    if conf.mode == "off":
+        return
+
+    # Text rects are never modified after compare, so serialising them can wait for the writer
+    save_record((output_dir, file_id, page_number, inside, outside, False))
+
+def save_edit(output_dir: Path, file_id: str, page_number: int, inside: List[Tuple[int, TextRect]], outside: List[Tuple[int, TextRect]]):
+    """Persist the text rects of a page that a layout edit moved inside or outside, with their positions."""
+    if conf.mode == "off":
+        return
+    save_record((output_dir, file_id, page_number, inside, outside, True))
+
+def save_record(record: Record):
+    global background_writer
+
+    if conf.mode == "sync":
+        write_records([record])
+        return
+
+    with background_lock:
+        if background_writer is None:
+            background_writer = BackgroundWriter()
+    background_writer.put(record)
+
+def flush():
+    """Block until every queued background write has been written."""
+    if background_writer is not None:
+        background_writer.flush()
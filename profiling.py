@@ -0,0 +1,188 @@
+# profiling.py
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from uuid import uuid4
+
+from loguru import logger
+
+# Slow request profiling configuration, opt-in through environment variables
+class ProfileConfig:
+    enabled: bool = os.environ.get("PROFILE_ENABLED", "0") == "1"
+    # Keep the profile of every request slower than threshold seconds
+    threshold: float = float(os.environ.get("PROFILE_THRESHOLD", "1.0"))
+    # Also keep this fraction of all profiled requests regardless of latency
+    sample_rate: float = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.0"))
+    # "sampler" walks the handler's stack every interval seconds and is cheap enough to leave on,
+    # "cprofile" records every call but slows the profiled request down considerably
+    engine: str = os.environ.get("PROFILE_ENGINE", "sampler")
+    interval: float = 0.005
+    directory: Path = Path(os.environ.get("PROFILE_DIR", "profiles"))
+    max_profiles: int = 200
+    # Token required by the endpoints listing and downloading profiles; empty disables them
+    token: str = os.environ.get("PROFILE_TOKEN", "")
+
+conf = ProfileConfig()
+
+class StackSampler:
+    """Sample the stack of one thread at a fixed interval into collapsed stack counts."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{Path(code.co_filename).name}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, path: Path):
+        # Collapsed stack format, readable by flamegraph.pl and speedscope
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+class ProfileSession:
+    """Profile of one request, filled in by the handler thread and stored by the middleware."""
+
+    def __init__(self):
+        self.meta: Dict = {}
+        self.profiler: Optional[cProfile.Profile] = None
+        self.sampler: Optional[StackSampler] = None
+
+    def start(self):
+        if conf.engine == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.sampler = StackSampler(threading.get_ident(), conf.interval)
+            self.sampler.start()
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def save(self, elapsed: float, path: str):
+        conf.directory.mkdir(parents=True, exist_ok=True)
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid4().hex[:8]}"
+        if self.profiler is not None:
+            profile_file = conf.directory / f"{profile_id}.prof"
+            self.profiler.dump_stats(profile_file)
+        else:
+            profile_file = conf.directory / f"{profile_id}.collapsed"
+            self.sampler.dump(profile_file)
+
+        meta = {"id": profile_id, "file": profile_file.name, "path": path, "elapsed": elapsed, "engine": conf.engine, **self.meta}
+        with open(conf.directory / f"{profile_id}.json", "w") as f:
+            json.dump(meta, f)
+        logger.info(f"Saved profile {profile_id} of {path} taking {elapsed:.3f}s")
+        prune_profiles()
+
+current_session: contextvars.ContextVar[Optional[ProfileSession]] = contextvars.ContextVar("current_session", default=None)
+
+def profiled(func: Callable) -> Callable:
+    """
+    Profile a sync endpoint in the thread it runs in.
+
+    The file_id and page_number arguments of the endpoint, or of its request model, are kept with the profile.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        session = current_session.get()
+        if session is None:
+            return func(*args, **kwargs)
+
+        for value in kwargs.values():
+            for key in ("file_id", "page_number"):
+                if hasattr(value, key):
+                    session.meta[key] = getattr(value, key)
+        for key in ("file_id", "page_number"):
+            if key in kwargs:
+                session.meta[key] = kwargs[key]
+
+        session.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            session.stop()
+
+    return wrapper
+
+def profile_middleware(input_sizes: Callable[[str, int], Dict]):
+    """
+    Build an HTTP middleware keeping the profiles of slow or sampled requests.
+
+    Args:
+        input_sizes: Returns the input sizes (text rect count, layout rect count, ...) of a file_id and page_number.
+    """
+    async def middleware(request, call_next):
+        if not conf.enabled:
+            return await call_next(request)
+
+        session = ProfileSession()
+        token = current_session.set(session)
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            current_session.reset(token)
+        elapsed = time.perf_counter() - start
+
+        started = session.profiler is not None or session.sampler is not None
+        if started and (elapsed >= conf.threshold or random.random() < conf.sample_rate):
+            if "file_id" in session.meta:
+                session.meta.update(input_sizes(session.meta["file_id"], session.meta.get("page_number")))
+            session.save(elapsed, request.url.path)
+        return response
+
+    return middleware
+
+def list_profiles() -> List[Dict]:
+    """Return the metadata of the stored profiles, newest first."""
+    if not conf.directory.exists():
+        return []
+    profiles = []
+    for meta_file in sorted(conf.directory.glob("*.json"), reverse=True):
+        with open(meta_file) as f:
+            profiles.append(json.load(f))
+    return profiles
+
+def profile_path(profile_id: str) -> Optional[Path]:
+    """Return the profile file of profile_id, if it exists."""
+    for meta in list_profiles():
+        if meta["id"] == profile_id:
+            return conf.directory / meta["file"]
+    return None
+
+def prune_profiles():
+    """Delete the oldest profiles beyond max_profiles."""
+    for meta in list_profiles()[conf.max_profiles:]:
+        (conf.directory / meta["file"]).unlink(missing_ok=True)
+        (conf.directory / f"{meta['id']}.json").unlink(missing_ok=True)
@@ -0,0 +1,97 @@
+# raster_cache.py
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from loguru import logger
+
+from metrics import Counter, Gauge, register
+
+# Page raster cache configuration
+class RasterCacheConfig:
+    # Longest side of the cached rasters, matching the detection model's training size
+    max_side: int = 1024
+    # Memory budget of the cache and how long a page stays cached after it was rendered
+    max_bytes: int = 2 * 1024 ** 3
+    ttl: float = 600.0
+
+conf = RasterCacheConfig()
+
+raster_cache_requests = register(Counter("doclaynet_raster_cache_requests_total", "Raster cache lookups by result."))
+raster_cache_bytes = register(Gauge("doclaynet_raster_cache_bytes", "Bytes held by the raster cache."))
+
+def inference_size(width: int, height: int, max_side: int = conf.max_side) -> Tuple[Tuple[int, int], float]:
+    """Width and height of a page of the given full resolution once at inference size, with the scale applied."""
+    scale = min(1.0, max_side / max(height, width))
+    return (round(width * scale), round(height * scale)), scale
+
+def to_inference_size(image: np.ndarray, max_side: int) -> Tuple[np.ndarray, float]:
+    """Downscale image so its longest side is at most max_side, returning it with the scale applied."""
+    height, width = image.shape[:2]
+    size, scale = inference_size(width, height, max_side)
+    if scale < 1.0:
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return image, scale
+
+class RasterCache:
+    """Bounded LRU of decoded page rasters keyed by (file_id, page_number), with a TTL."""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: "OrderedDict[Tuple[str, int], Tuple[np.ndarray, float, float]]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def put(self, file_id: str, page_number: int, image: np.ndarray, scale: float):
+        """Cache a raster already at inference size, with the scale from the full page resolution."""
+        if image.nbytes > self.max_bytes:
+            return
+
+        # Cached rasters are shared between requests, so they must never be written to
+        image.setflags(write=False)
+        key = (file_id, page_number)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[0].nbytes
+            self.entries[key] = (image, scale, time.monotonic() + self.ttl)
+            self.size += image.nbytes
+            while self.size > self.max_bytes:
+                _, (evicted, _, _) = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+            raster_cache_bytes.set(self.size)
+
+    def get(self, file_id: str, page_number: int) -> Optional[Tuple[np.ndarray, float]]:
+        """Return the cached raster and its scale, or None on a miss."""
+        key = (file_id, page_number)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self.size -= self.entries.pop(key)[0].nbytes
+                raster_cache_bytes.set(self.size)
+                entry = None
+            if entry is None:
+                raster_cache_requests.inc(result="miss")
+                return None
+            self.entries.move_to_end(key)
+        raster_cache_requests.inc(result="hit")
+        return entry[0], entry[1]
+
+    def discard(self, file_id: str):
+        """Drop every cached page of a document."""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == file_id]:
+                self.size -= self.entries.pop(key)[0].nbytes
+            raster_cache_bytes.set(self.size)
+
+cache = RasterCache(conf.max_bytes, conf.ttl)
+
+def cache_page(file_id: str, page_number: int, image: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Downscale a full resolution page to inference size, cache it and return it with its scale."""
+    small, scale = to_inference_size(image, conf.max_side)
+    cache.put(file_id, page_number, small, scale)
+    logger.debug(f"Cached page {page_number} of file_id {file_id} at {small.shape[1]}x{small.shape[0]}")
+    return small, scale
@@ -1,9 +1,14 @@
 from collections import defaultdict
-from typing import List, Dict, Tuple
+from functools import lru_cache
+from typing import List, Dict, NamedTuple, Tuple
 
 from loguru import logger
 
 from models import LabelBox, TextRect
+from font_stats import FontLabels
+from repeating import in_regions
+from metrics import timer
+from tracing import get_tracer
 
 # Define the first echelon layout types
 FIRST_ECHELON_TYPES = {"Picture", "Table", "Page-header", "Page-footer", "Footnote"}
@@ -20,6 +25,9 @@ INSIDE_THRESHOLD = 0.95
 OVERLAP_THRESHOLD = 0.10
 LINE_OVERLAP_THRESHOLD = 0.98
 
+# Number of reclassified pages kept in memory
+RESULT_CACHE_SIZE = 256
+
 def validate_rectangle(rect: LabelBox) -> bool:
     """Ensure the rectangle has valid dimensions."""
     width = rect.box[2] - rect.box[0]
@@ -52,17 +60,20 @@ def within_same_line(box1: List[float], box2: List[float], threshold=LINE_OVERLA
 
 def adjust_rect(rect: LabelBox, first_echelon_rect: LabelBox) -> List[LabelBox]:
     """Adjust a rect to not overlap with a first echelon rect."""
+    trace = get_tracer()
     if is_inside(rect.box, first_echelon_rect.box):
-        logger.info(f"Reclassified other_rects inside first_echelon_rect.")
+        if trace:
+            trace("first_echelon_delete", rect=tuple(rect.box), first_echelon=first_echelon_rect.label, first_echelon_box=tuple(first_echelon_rect.box))
         return []  # Delete the rect
     elif is_inside(first_echelon_rect.box, rect.box):
-        logger.info(f"Reclassified first_echelon_rect inside other_rects.")
+        if trace:
+            trace("first_echelon_split", rect=tuple(rect.box), first_echelon=first_echelon_rect.label, first_echelon_box=tuple(first_echelon_rect.box))
         # Split the rect into parts that are outside the first echelon rect
         split_rects = []
         if rect.box[1] < first_echelon_rect.box[1]:
-            split_rects.append(LabelBox(label=rect.label, box=[rect.box[0], rect.box[1], rect.box[2], first_echelon_rect.box[1] - 1]))
+            split_rects.append(LabelBox(label=rect.label, box=[rect.box[0], rect.box[1], rect.box[2], first_echelon_rect.box[1] - 1], confidence=rect.confidence))
         if rect.box[3] > first_echelon_rect.box[3]:
-            split_rects.append(LabelBox(label=rect.label, box=[rect.box[0], first_echelon_rect.box[3] + 1, rect.box[2], rect.box[3]]))
+            split_rects.append(LabelBox(label=rect.label, box=[rect.box[0], first_echelon_rect.box[3] + 1, rect.box[2], rect.box[3]], confidence=rect.confidence))
         return split_rects
     else:
         # if within_same_line(rect.box, first_echelon_rect.box):
@@ -76,27 +87,87 @@ def adjust_rect(rect: LabelBox, first_echelon_rect: LabelBox) -> List[LabelBox]:
         return [rect]
 
 
-def reclassify_layout(file_id: str, page_number: int, comparison_results: Dict, layout_data: Dict) -> List[LabelBox]:
+def reclassify_layout(file_id: str, page_number: int, comparison_results: Dict, layout_data: Dict, masked_regions: List[LabelBox] = None, font_labels: FontLabels = None) -> List[LabelBox]:
+    """
+    Reclassify the layout of a page without modifying the stored layout or comparison results.
+
+    The inputs are frozen into tuples, so identical pages share one memoised result and
+    concurrent requests never see each other's intermediate rects. font_labels are the
+    document-wide font labels from FontStatistics.labels(); without them fonts are labelled
+    from this page alone.
+    """
     inside_rects = comparison_results[(file_id, page_number)]["inside"]
     outside_rects = comparison_results[(file_id, page_number)]["outside"]
     layout_rects = layout_data[file_id][page_number]
 
     logger.info(f"Reclassifying layout for file_id {file_id}, page_number {page_number}")
 
+    with timer("reclassify_snapshot"):
+        snapshot = (
+            snapshot_layout(layout_rects),
+            snapshot_text(inside_rects),
+            snapshot_text(outside_rects),
+            tuple(tuple(region.box) for region in masked_regions or []),
+            font_labels,
+        )
+    trace = get_tracer()
+    with timer("reclassify"):
+        if trace and trace.keep:
+            # A traced run has to go through every pass, so it bypasses the memoised result
+            result = reclassify_snapshot.__wrapped__(*snapshot)
+        else:
+            result = reclassify_snapshot(*snapshot)
+
+    # Hand out fresh objects so callers can't alter the memoised result
+    return [LabelBox(label=label, box=list(box), confidence=confidence) for label, box, confidence in result]
+
+class TextSnapshot(NamedTuple):
+    """Immutable stand-in for a TextRect, read by the reclassify passes."""
+    box: Tuple[float, float, float, float]
+    text: str
+    fontname: str
+    size: float
+
+LayoutSnapshot = Tuple[Tuple[str, Tuple[float, ...], float], ...]
+
+def snapshot_layout(layout_rects: List[LabelBox]) -> LayoutSnapshot:
+    return tuple((rect.label, tuple(rect.box), rect.confidence) for rect in layout_rects)
+
+def snapshot_text(text_rects: List[TextRect]) -> Tuple[TextSnapshot, ...]:
+    return tuple(TextSnapshot(tuple(rect.box), rect.text, rect.fontname, rect.size) for rect in text_rects)
+
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
+def reclassify_snapshot(layout: LayoutSnapshot, inside_rects: Tuple[TextSnapshot, ...], outside_rects: Tuple[TextSnapshot, ...], masked_boxes: Tuple[Tuple[float, ...], ...], font_labels: FontLabels = None) -> LayoutSnapshot:
+    # The passes below work in place, so give them their own copies of the layout rects
+    layout_rects = [LabelBox(label=label, box=list(box), confidence=confidence) for label, box, confidence in layout]
+
+    # Text inside repeating header/footer regions is already resolved at document level
+    if masked_boxes:
+        inside_rects = [rect for rect in inside_rects if not in_regions(rect.box, masked_boxes)]
+        outside_rects = [rect for rect in outside_rects if not in_regions(rect.box, masked_boxes)]
+
     # Step 1: Handle first echelon layout types
-    processed_rects, first_echelon_rects = handle_first_echelon_rects(layout_rects)
+    with timer("reclassify_first_echelon"):
+        processed_rects, first_echelon_rects = handle_first_echelon_rects(layout_rects)
 
     # Step 2: Handle rects inside other rects
-    processed_rects = handle_rects_inside_other_rects(processed_rects)
+    with timer("reclassify_inside"):
+        processed_rects = handle_rects_inside_other_rects(processed_rects)
     
     # Step 3: Handle rects inside other rects
-    processed_rects = handle_rects_overlap_other_rects(processed_rects)
+    with timer("reclassify_overlap"):
+        processed_rects = handle_rects_overlap_other_rects(processed_rects)
 
     # Step 4: Combine overlapping rects within a line
-    processed_rects = combine_rects_within_line(processed_rects)
+    with timer("reclassify_combine_line"):
+        processed_rects = combine_rects_within_line(processed_rects)
     
-    # Step 5: Split layout rects based on font analysis
-    font_stats = calculate_font_statistics(inside_rects, processed_rects)
+    # Step 5: Split layout rects based on font analysis, using the document-wide font labels when available
+    with timer("reclassify_font_statistics"):
+        if font_labels is not None:
+            font_stats = dict(font_labels)
+        else:
+            font_stats = calculate_font_statistics(inside_rects, processed_rects)
     # processed_rects = split_rects_based_on_fonts(processed_rects, inside_rects, font_stats)
 
     # Step 6: Validate and return the list of rectangles
@@ -104,10 +175,11 @@ def reclassify_layout(file_id: str, page_number: int, comparison_results: Dict,
     processed_rects.extend(first_echelon_rects)
     
     # Step 7: Regroup text rects outside from processed rects
-    processed_rects = regroup_outside_text(outside_rects, processed_rects, font_stats)
+    with timer("reclassify_regroup"):
+        processed_rects = regroup_outside_text(list(outside_rects), processed_rects, font_stats)
     
     logger.info(f"Reclassified layout contains {len(processed_rects)} rects.")
-    return processed_rects
+    return snapshot_layout(processed_rects)
 
 def handle_first_echelon_rects(layout_rects: List[LabelBox]) -> List[LabelBox]:
     first_echelon_rects = [rect for rect in layout_rects if rect.label in FIRST_ECHELON_TYPES]
@@ -137,6 +209,7 @@ def handle_rects_inside_other_rects(layout_rects: List[LabelBox]) -> List[LabelB
     layout_rects.sort(key=lambda rect: (rect.box[2] - rect.box[0]) * (rect.box[3] - rect.box[1]), reverse=True)
     
     adjusted_rects = []
+    trace = get_tracer()
     
     while layout_rects:
         rect = layout_rects.pop(0)  # Take the largest rect
@@ -145,7 +218,8 @@ def handle_rects_inside_other_rects(layout_rects: List[LabelBox]) -> List[LabelB
         # Compare only against larger rectangles already added to adjusted_rects
         for other_rect in adjusted_rects:
             if is_inside(rect.box, other_rect.box):
-                logger.debug(f"Rect {rect.box} is inside {other_rect.box}, deleting it.")
+                if trace:
+                    trace("inside_delete", rect=tuple(rect.box), label=rect.label, container=tuple(other_rect.box))
                 contained_in_other_rect = True
                 break  # No need to check further if it's inside another rect
 
@@ -160,6 +234,7 @@ def handle_rects_overlap_other_rects(layout_rects: List[LabelBox]) -> List[Label
     This function adjusts rectangles that overlap with each other to eliminate overlap.
     """
     adjusted_rects = []
+    trace = get_tracer()
 
     while layout_rects:
         rect = layout_rects.pop(0)  # Take the first rect
@@ -167,21 +242,20 @@ def handle_rects_overlap_other_rects(layout_rects: List[LabelBox]) -> List[Label
         while i < len(layout_rects):
             other_rect = layout_rects[i]
             if rects_overlap(rect.box, other_rect.box):
-                logger.debug(f"Rect {rect.box} overlaps with {other_rect.box}, adjusting them.")
-
                 # Determine if the overlap is primarily vertical or horizontal
                 vertical_overlap = min(rect.box[3], other_rect.box[3]) - max(rect.box[1], other_rect.box[1])
                 horizontal_overlap = min(rect.box[2], other_rect.box[2]) - max(rect.box[0], other_rect.box[0])
 
+                if trace:
+                    trace("overlap_adjust", rect=tuple(rect.box), other=tuple(other_rect.box), vertical=vertical_overlap > horizontal_overlap)
+
                 if vertical_overlap > horizontal_overlap:
-                    logger.debug(f"Primarily vertical overlap")
                     # Primarily vertical overlap
                     if rect.box[0] < other_rect.box[0]:
                         rect.box[2] = other_rect.box[0]  # Adjust right of rect to left of other_rect
                     else:
                         other_rect.box[2] = rect.box[0]  # Adjust right of other_rect to left of rect
                 else:
-                    logger.debug(f"Primarily horizontal overlap")
                     # Primarily horizontal overlap
                     if rect.box[1] < other_rect.box[1]:
                         rect.box[3] = other_rect.box[1]  # Adjust bottom of rect to top of other_rect
@@ -264,6 +338,7 @@ def calculate_font_statistics(inside_rects: List[TextRect], layout_rects: List[L
 def split_rects_based_on_fonts(layout_rects: List[LabelBox], inside_rects: List[TextRect], font_to_label_map: Dict[Tuple[str, float], str]) -> List[LabelBox]:
     adjusted_rects = []
     seen_rects = set()  # Track already split rectangles to avoid infinite loops
+    trace = get_tracer()
 
     while layout_rects:
         rect = layout_rects.pop(0)  # Remove the first element
@@ -274,11 +349,9 @@ def split_rects_based_on_fonts(layout_rects: List[LabelBox], inside_rects: List[
             continue
         
         if needs_split_based_on_fonts(rect, inside_rects, font_to_label_map):
-            logger.info(f"Reclassified needs_split_based_on_fonts {rect.box}")
             split_rects = split_rect_based_on_fonts(rect, inside_rects, font_to_label_map)
-            logger.debug(f"Splitting rect {rect.box} based on font analysis.")
-            for split_rect in split_rects:
-                logger.debug(f"Splited rect {split_rect.box}")
+            if trace:
+                trace("font_split", rect=tuple(rect.box), split=[(split_rect.label, tuple(split_rect.box)) for split_rect in split_rects])
             layout_rects.extend(split_rects)
             seen_rects.add(rect_key)
         else:
@@ -300,15 +373,13 @@ def needs_split_based_on_fonts(rect: LabelBox, inside_rects: List[TextRect], fon
         True if the rect needs to be split based on font analysis, False otherwise.
     """
     fonts_in_rect = [(r.fontname, r.size) for r in inside_rects if r.box[0] >= rect.box[0] and r.box[2] <= rect.box[2] and r.box[1] >= rect.box[1] and r.box[3] <= rect.box[3]]
-    logger.debug(f"Fonts in Rect {fonts_in_rect}")
     distinct_labels = set(font_to_label_map.get((font, size), rect.label) for font, size in fonts_in_rect)
-    
-    if len(distinct_labels) > 1:
-        logger.debug(f"Rect {rect} has multiple distinct labels ({distinct_labels}) based on font distribution and may need to be split.")
-        return True
-    
-    logger.debug(f"Rect {rect} does not need to be split based on font analysis.")
-    return False
+
+    trace = get_tracer()
+    if trace:
+        trace("font_labels", rect=tuple(rect.box), label=rect.label, fonts=sorted(set(fonts_in_rect)), labels=sorted(distinct_labels))
+
+    return len(distinct_labels) > 1
 
 def split_rect_based_on_fonts(rect: LabelBox, inside_rects: List[TextRect], font_to_label_map: Dict[Tuple[str, float], str]) -> List[LabelBox]:
     split_rects = []
@@ -322,7 +393,7 @@ def split_rect_based_on_fonts(rect: LabelBox, inside_rects: List[TextRect], font
             y1 = max(r.box[3] for r in matching_rects)
             
             new_label = font_to_label_map.get((font[0], font[1]), rect.label)  # Default to the original label if not found
-            new_rect = LabelBox(label=new_label, box=[x0, y0, x1, y1])
+            new_rect = LabelBox(label=new_label, box=[x0, y0, x1, y1], confidence=rect.confidence)
             
             # Ensure the new rect is meaningfully different from the original to avoid re-triggering the split
             if rect.box != new_rect.box:
@@ -333,12 +404,14 @@ def split_rect_based_on_fonts(rect: LabelBox, inside_rects: List[TextRect], font
 def combine_rects_within_line(layout_rects: List[LabelBox]) -> List[LabelBox]:
     """Combine overlapping rects that are within the same line."""
     adjusted_rects = []
+    trace = get_tracer()
     while layout_rects:
         rect = layout_rects.pop(0)
         combined = False
         for i, existing_rect in enumerate(adjusted_rects):
             if within_same_line(rect.box, existing_rect.box):
-                logger.debug(f"Combining rect {rect.box} with {existing_rect.box} within the same line.")
+                if trace:
+                    trace("line_combine", rect=tuple(rect.box), label=rect.label, existing=tuple(existing_rect.box), existing_label=existing_rect.label)
                 adjusted_rects[i] = combine_rects_update_one(existing_rect, rect)
                 combined = True
                 break
@@ -357,10 +430,8 @@ def combine_rects_update_one(rect1: LabelBox, rect2: LabelBox) -> LabelBox:
     Returns:
         The updated rectangle.
     """
-    logger.debug(f"Combining rect {rect1.box} (label: {rect1.label}) and {rect2.box} (label: {rect2.label}) by updating.")
-
     # Determine the label based on priority
-    label = rect1.label if LABEL_PRIORITY[rect1.label] >= LABEL_PRIORITY[rect2.label] else rect2.label
+    label = rect1.label if LABEL_PRIORITY.get(rect1.label, 0) >= LABEL_PRIORITY.get(rect2.label, 0) else rect2.label
 
     # Update rect1 to encompass rect2
     rect1.box = [
@@ -370,6 +441,7 @@ def combine_rects_update_one(rect1: LabelBox, rect2: LabelBox) -> LabelBox:
         max(rect1.box[3], rect2.box[3])
     ]
     rect1.label = label
+    rect1.confidence = max(rect1.confidence, rect2.confidence)
     
     return rect1
 
@@ -377,13 +449,13 @@ def combine_rects_update_one(rect1: LabelBox, rect2: LabelBox) -> LabelBox:
 def split_rect(larger_rect: LabelBox, smaller_rect: LabelBox) -> List[LabelBox]:
     new_rects = []
     if smaller_rect.box[0] > larger_rect.box[0]:
-        new_rects.append(LabelBox(label=larger_rect.label, box=[larger_rect.box[0], larger_rect.box[1], smaller_rect.box[0] - 1, larger_rect.box[3]]))
+        new_rects.append(LabelBox(label=larger_rect.label, box=[larger_rect.box[0], larger_rect.box[1], smaller_rect.box[0] - 1, larger_rect.box[3]], confidence=larger_rect.confidence))
     if smaller_rect.box[2] < larger_rect.box[2]:
-        new_rects.append(LabelBox(label=larger_rect.label, box=[smaller_rect.box[2] + 1, larger_rect.box[1], larger_rect.box[2], larger_rect.box[3]]))
+        new_rects.append(LabelBox(label=larger_rect.label, box=[smaller_rect.box[2] + 1, larger_rect.box[1], larger_rect.box[2], larger_rect.box[3]], confidence=larger_rect.confidence))
     if smaller_rect.box[1] > larger_rect.box[1]:
-        new_rects.append(LabelBox(label=larger_rect.label, box=[max(larger_rect.box[0], smaller_rect.box[0]), larger_rect.box[1], min(larger_rect.box[2], smaller_rect.box[2]), smaller_rect.box[1] - 1]))
+        new_rects.append(LabelBox(label=larger_rect.label, box=[max(larger_rect.box[0], smaller_rect.box[0]), larger_rect.box[1], min(larger_rect.box[2], smaller_rect.box[2]), smaller_rect.box[1] - 1], confidence=larger_rect.confidence))
     if smaller_rect.box[3] < larger_rect.box[3]:
-        new_rects.append(LabelBox(label=larger_rect.label, box=[max(larger_rect.box[0], smaller_rect.box[0]), smaller_rect.box[3] + 1, min(larger_rect.box[2], smaller_rect.box[2]), larger_rect.box[3]]))
+        new_rects.append(LabelBox(label=larger_rect.label, box=[max(larger_rect.box[0], smaller_rect.box[0]), smaller_rect.box[3] + 1, min(larger_rect.box[2], smaller_rect.box[2]), larger_rect.box[3]], confidence=larger_rect.confidence))
 
     return new_rects
 
@@ -403,8 +475,8 @@ def regroup_outside_text(outside_rects: List[TextRect], layout_rects: List[Label
     new_layout_rects = []
     grouped_rects = set()  # Track already combined rectangles
 
-    # Sort outside_rects by y0 (top-to-bottom)
-    outside_rects.sort(key=lambda r: r.box[1])
+    # Sort outside_rects by y0 (top-to-bottom) without reordering the caller's list
+    outside_rects = sorted(outside_rects, key=lambda r: r.box[1])
 
     i = 0
     while i < len(outside_rects):
@@ -0,0 +1,132 @@
+# repeating.py
+import hashlib
+import math
+import re
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from loguru import logger
+
+from models import LabelBox, RepeatingRegion, TextRect
+
+# Labels that repeat on nearly every page of a document
+REPEATING_TYPES = {"Page-header", "Page-footer"}
+
+# Tolerance (in PDF points) on each coordinate when matching region positions across pages
+POSITION_GRID = 12.0
+# A region must appear on at least this fraction of the pages to count as repeating
+MIN_PAGE_RATIO = 0.5
+
+DIGITS = re.compile(r"\d+")
+
+def region_text(text_rects: List[TextRect], box: List[float]) -> str:
+    """Concatenate the text of the rects whose center lies inside box (PDF coordinates)."""
+    chars = []
+    for rect in text_rects:
+        center_x = (rect.box[0] + rect.box[2]) / 2
+        center_y = (rect.box[1] + rect.box[3]) / 2
+        if box[0] <= center_x <= box[2] and box[1] <= center_y <= box[3]:
+            chars.append(rect.text)
+    return "".join(chars)
+
+def page_region_text(pages_text, page_number: int, box: List[float]) -> str:
+    """Text of a region of a page; lazy page text is extracted once per page and shared by every region."""
+    return region_text(pages_text.get(page_number, []), box)
+
+def text_hash(text: str) -> str:
+    """Hash region text, ignoring whitespace and page numbers."""
+    normalized = DIGITS.sub("#", "".join(text.split()))
+    return hashlib.md5(normalized.encode("utf-8")).hexdigest()
+
+def near(box: List[float], other: List[float]) -> bool:
+    """Check if every coordinate of box is within POSITION_GRID of other."""
+    return all(abs(a - b) <= POSITION_GRID for a, b in zip(box, other))
+
+def match_candidate(candidates: List[Tuple[List[float], Dict]], box: List[float]) -> Dict:
+    """
+    Return the occurrences of the candidate whose first box lies within POSITION_GRID of box,
+    adding a new candidate when none does.
+    """
+    for anchor, boxes in candidates:
+        if near(anchor, box):
+            return boxes
+    boxes = {}
+    candidates.append((box, boxes))
+    return boxes
+
+def find_repeating_regions(file_id: str, layout_data: Dict, text_data: Dict, scaling_factors: Dict, min_page_ratio: float = MIN_PAGE_RATIO) -> Dict[int, List[RepeatingRegion]]:
+    """
+    Find Page-header and Page-footer regions that repeat across the pages of a document.
+
+    Regions are matched by label, by a hash of the text found inside them and by position,
+    within POSITION_GRID of each other. Repeating regions are propagated to the layout of every
+    page whose text matches, including pages on which detection missed them, with the mean
+    confidence of the detections.
+
+    Args:
+        file_id: The document to analyse.
+        layout_data: Layout rects by file_id and page_number (image coordinates), updated in place.
+        text_data: Text rects by file_id and page_number (PDF coordinates); lazily extracted
+            documents only extract the regions looked at.
+        scaling_factors: Scaling factors from PDF to image coordinates by (file_id, page_number).
+        min_page_ratio: Minimum fraction of pages a region must appear on.
+
+    Returns:
+        A dictionary mapping each page_number to its repeating regions (image coordinates), each
+        with the fraction of pages it was detected on.
+    """
+    pages_layout = layout_data.get(file_id, {})
+    pages_text = text_data.get(file_id, {})
+    page_count = max(len(pages_text), len(pages_layout))
+    min_pages = max(2, math.ceil(min_page_ratio * page_count))
+
+    # Collect every detected header/footer by label and text hash, then by position
+    candidates = defaultdict(list)  # (label, digest) -> [(first box, {page_number: (box in PDF coordinates, confidence)})]
+    for page_number, layout_rects in sorted(pages_layout.items()):
+        scale_x, scale_y = scaling_factors.get((file_id, page_number), (1, 1))
+        for rect in layout_rects:
+            if rect.label not in REPEATING_TYPES:
+                continue
+            pdf_box = [rect.box[0] / scale_x, rect.box[1] / scale_y, rect.box[2] / scale_x, rect.box[3] / scale_y]
+            digest = text_hash(page_region_text(pages_text, page_number, pdf_box))
+            boxes = match_candidate(candidates[(rect.label, digest)], pdf_box)
+            boxes.setdefault(page_number, (pdf_box, rect.confidence))
+
+    repeating_regions = defaultdict(list)
+    for (label, digest), occurrences in candidates.items():
+        for _, boxes in occurrences:
+            if len(boxes) >= min_pages:
+                propagate_region(file_id, label, digest, boxes, page_count, pages_layout, pages_text, scaling_factors, repeating_regions)
+
+    return dict(repeating_regions)
+
+def propagate_region(file_id: str, label: str, digest: str, boxes: Dict, page_count: int, pages_layout: Dict, pages_text, scaling_factors: Dict, repeating_regions: Dict):
+    """Add a repeating region to every page it was detected on or whose text matches it."""
+    # Average the detected boxes to get a stable region for propagation
+    region = [sum(box[i] for box, _ in boxes.values()) / len(boxes) for i in range(4)]
+    mean_confidence = sum(confidence for _, confidence in boxes.values()) / len(boxes)
+    page_ratio = len(boxes) / page_count
+    logger.info(f"Found repeating {label} on {len(boxes)} of {page_count} pages for file_id {file_id}.")
+
+    for page_number in set(pages_text) | set(pages_layout):
+        scale_x, scale_y = scaling_factors.get((file_id, page_number), (1, 1))
+        pdf_box, confidence = boxes.get(page_number, (None, mean_confidence))
+        if pdf_box is None:
+            # Only propagate onto pages whose text matches, and never an empty region
+            text = page_region_text(pages_text, page_number, region)
+            if not text.strip() or text_hash(text) != digest:
+                continue
+            pdf_box = region
+
+        box = [pdf_box[0] * scale_x, pdf_box[1] * scale_y, pdf_box[2] * scale_x, pdf_box[3] * scale_y]
+        repeating_regions[page_number].append(RepeatingRegion(label=label, box=box, confidence=confidence, page_ratio=page_ratio))
+
+        if page_number not in boxes and page_number in pages_layout:
+            pages_layout[page_number].append(LabelBox(label=label, box=box, confidence=confidence))
+            logger.info(f"Propagated repeating {label} to page_number {page_number}.")
+
+def in_regions(box: List[float], regions: List[List[float]]) -> bool:
+    """Check if the center of box lies inside any of the regions."""
+    center_x = (box[0] + box[2]) / 2
+    center_y = (box[1] + box[3]) / 2
+    return any(region[0] <= center_x <= region[2] and region[1] <= center_y <= region[3] for region in regions)
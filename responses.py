@@ -0,0 +1,127 @@
+# responses.py
+import json
+from typing import Any, Callable, List, Optional, get_args
+
+from fastapi import HTTPException, Request, Response
+from pydantic import BaseModel
+
+from models import LabelBox, TextRect
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_TYPE = "application/json"
+COLUMNAR_TYPE = "application/vnd.doclaynet.columnar+json"
+MSGPACK_TYPE = "application/x-msgpack"
+
+# Values accepted by the "format" query parameter, mapped to their media types
+FORMATS = {
+    "json": JSON_TYPE,
+    "columnar": COLUMNAR_TYPE,
+    "msgpack": MSGPACK_TYPE,
+}
+
+def columnar_text_rects(rects: List[TextRect]) -> dict:
+    """Encode text rects as parallel arrays, with font names stored once in a dictionary."""
+    fonts = {}
+    columns = {"x0": [], "y0": [], "x1": [], "y1": [], "text": [], "font": [], "size": []}
+    for rect in rects:
+        columns["x0"].append(rect.box[0])
+        columns["y0"].append(rect.box[1])
+        columns["x1"].append(rect.box[2])
+        columns["y1"].append(rect.box[3])
+        columns["text"].append(rect.text)
+        columns["font"].append(fonts.setdefault(rect.fontname, len(fonts)))
+        columns["size"].append(rect.size)
+    columns["fonts"] = list(fonts)
+    return columns
+
+def columnar_label_boxes(boxes: List[LabelBox]) -> dict:
+    """Encode label boxes as parallel arrays, with label names stored once in a dictionary."""
+    labels = {}
+    columns = {"x0": [], "y0": [], "x1": [], "y1": [], "label": [], "confidence": []}
+    for box in boxes:
+        columns["x0"].append(box.box[0])
+        columns["y0"].append(box.box[1])
+        columns["x1"].append(box.box[2])
+        columns["y1"].append(box.box[3])
+        columns["label"].append(labels.setdefault(box.label, len(labels)))
+        columns["confidence"].append(box.confidence)
+    columns["labels"] = list(labels)
+    return columns
+
+COLUMNAR_ENCODERS = {
+    TextRect: columnar_text_rects,
+    LabelBox: columnar_label_boxes,
+}
+
+def columnar_encoder(content: list, item_type: Optional[type]) -> Optional[Callable[[list], dict]]:
+    # An empty list has no item to look at, so its item type comes from the model it belongs to
+    item_type = type(content[0]) if content else item_type
+    for model, encoder in COLUMNAR_ENCODERS.items():
+        if isinstance(item_type, type) and issubclass(item_type, model):
+            return encoder
+    return None
+
+def field_item_type(field) -> Optional[type]:
+    # pydantic 1 exposes the item type of a List field as type_, pydantic 2 only its annotation
+    item_type = getattr(field, "type_", None)
+    if item_type is None:
+        args = get_args(getattr(field, "annotation", None))
+        item_type = args[0] if args else None
+    return item_type
+
+def to_columnar(content: Any, item_type: Optional[type] = None) -> Any:
+    """
+    Recursively replace lists of TextRect and LabelBox with their columnar form.
+
+    item_type is the item type of content when it is a list, so that empty lists are encoded too.
+    """
+    if isinstance(content, list):
+        encoder = columnar_encoder(content, item_type)
+        if encoder is not None:
+            return encoder(content)
+    if isinstance(content, BaseModel):
+        return {name: to_columnar(getattr(content, name), field_item_type(field)) for name, field in content.__fields__.items()}
+    if isinstance(content, dict):
+        return {key: to_columnar(value) for key, value in content.items()}
+    if isinstance(content, (list, tuple)):
+        return [to_columnar(value) for value in content]
+    return content
+
+def requested_format(request: Request) -> str:
+    """Pick the response format from the "format" query parameter or the Accept header."""
+    format_name = request.query_params.get("format")
+    if format_name is not None:
+        if format_name not in FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unknown format {format_name}, expected one of {', '.join(FORMATS)}.")
+        return format_name
+
+    accept = request.headers.get("accept", "")
+    for name, media_type in FORMATS.items():
+        if name != "json" and media_type in accept:
+            return name
+    return "json"
+
+def negotiate(request: Request, content: Any, item_type: Optional[type] = None) -> Any:
+    """
+    Encode a response according to the format the client asked for.
+
+    Plain JSON returns the content unchanged so FastAPI validates it against the response model.
+    The columnar and msgpack formats encode every list of text rects or label boxes as parallel
+    arrays, which is several times smaller for pages with thousands of characters. item_type is
+    the item type of content when it is a list, so an empty list still gets its columnar form.
+    """
+    format_name = requested_format(request)
+    if format_name == "json":
+        return content
+
+    columnar = to_columnar(content, item_type)
+    if format_name == "msgpack":
+        if msgpack is None:
+            raise HTTPException(status_code=406, detail="msgpack is not installed on the server.")
+        return Response(content=msgpack.packb(columnar, use_bin_type=True), media_type=MSGPACK_TYPE)
+
+    return Response(content=json.dumps(columnar, ensure_ascii=False, separators=(",", ":")), media_type=COLUMNAR_TYPE)
@@ -0,0 +1,261 @@
+# storage.py
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set
+
+from loguru import logger
+
+from metrics import Counter, Gauge, register
+
+# Storage lifecycle configuration
+class StorageConfig:
+    # Root directory of each kind of file; documents get their own directory under a two character shard
+    roots: Dict[str, Path] = {
+        "uploads": Path("uploads"),
+        "images": Path("images"),
+        "outputs": Path("outputs"),
+        "overlays": Path("overlays"),
+    }
+    # Documents untouched for max_age seconds are deleted
+    max_age: float = float(os.environ.get("STORAGE_MAX_AGE", 24 * 3600))
+    # Above quota bytes the least recently used documents are deleted until usage is below low_watermark * quota
+    quota: int = int(os.environ.get("STORAGE_QUOTA", 20 * 1024 ** 3))
+    low_watermark: float = 0.8
+    # Documents used within grace seconds are never deleted, so live sessions keep their files
+    grace: float = float(os.environ.get("STORAGE_GRACE", 600))
+    sweep_interval: float = float(os.environ.get("STORAGE_SWEEP_INTERVAL", 300))
+
+conf = StorageConfig()
+
+storage_bytes = register(Gauge("doclaynet_storage_bytes", "Bytes stored on disk by kind."))
+storage_documents = register(Gauge("doclaynet_storage_documents", "Documents stored on disk."))
+storage_deleted = register(Counter("doclaynet_storage_deleted_total", "Documents deleted by reason."))
+
+class StorageFull(Exception):
+    """Raised when usage stays above the quota after deleting every document that may be deleted."""
+
+class DocumentDeleted(Exception):
+    """Raised when a document that is being deleted is used."""
+
+def directory_size(path: Path) -> int:
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_size(Path(entry.path))
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            continue
+    return total
+
+class Document:
+    def __init__(self, last_access: float):
+        self.last_access = last_access
+        self.sizes: Dict[str, int] = {}
+
+    @property
+    def size(self) -> int:
+        return sum(self.sizes.values())
+
+class Storage:
+    """
+    Lifecycle of the files of every document: where they live, how much space they take and when they go.
+
+    Each document has a directory per kind, sharded by the first two characters of its
+    file_id, so no directory grows with the number of documents. A sweeper deletes
+    documents idle for longer than max_age, and the least recently used ones while usage is
+    above the quota. Callbacks registered with on_delete run before a document's files are
+    removed, so in-memory state and caches never point at deleted files.
+
+    Documents are marked as deleting under the lock and removed outside it, so requests for
+    other documents never wait for a sweep, while using a document being deleted raises
+    DocumentDeleted.
+    """
+
+    def __init__(self, roots: Dict[str, Path], max_age: float, quota: int, low_watermark: float, grace: float):
+        self.roots = roots
+        self.max_age = max_age
+        self.quota = quota
+        self.low_watermark = low_watermark
+        self.grace = grace
+
+        self.documents: Dict[str, Document] = {}
+        self.dirty: Set[str] = set()  # Documents whose size must be measured again
+        self.deleting: Set[str] = set()  # Documents whose files are being deleted
+        self.callbacks: List[Callable[[List[str]], None]] = []
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+        for root in roots.values():
+            root.mkdir(exist_ok=True)
+        self.discover()
+
+    def discover(self):
+        """Register the documents already on disk, aged by their directory's modification time."""
+        for root in self.roots.values():
+            for shard in os.scandir(root):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.is_dir():
+                        document = self.documents.setdefault(entry.name, Document(entry.stat().st_mtime))
+                        document.last_access = max(document.last_access, entry.stat().st_mtime)
+                        self.dirty.add(entry.name)
+        logger.info(f"Found {len(self.documents)} stored documents.")
+
+    def on_delete(self, callback: Callable[[List[str]], None]):
+        """Call callback(file_ids) before the files of the documents deleted together are deleted."""
+        self.callbacks.append(callback)
+
+    def touch(self, file_id: str):
+        """Record that a document is in use, raising DocumentDeleted if it is being deleted."""
+        with self.lock:
+            if file_id in self.deleting:
+                raise DocumentDeleted(file_id)
+            document = self.documents.setdefault(file_id, Document(time.time()))
+            document.last_access = time.time()
+            self.dirty.add(file_id)
+
+    def path(self, kind: str, file_id: str) -> Path:
+        """Return the directory of one kind of file of a document, without creating it."""
+        return self.roots[kind] / file_id[:2] / file_id
+
+    def document_dir(self, kind: str, file_id: str) -> Path:
+        """Return, creating it if needed, the directory of one kind of file of a document, unless it is being deleted."""
+        self.touch(file_id)
+        path = self.path(kind, file_id)
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def usage(self) -> int:
+        with self.lock:
+            return sum(document.size for document in self.documents.values())
+
+    def measure(self):
+        """Measure the documents written to since the last sweep and update the usage metrics."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        for file_id in dirty:
+            sizes = {kind: directory_size(self.path(kind, file_id)) for kind in self.roots}
+            with self.lock:
+                if file_id in self.documents:
+                    self.documents[file_id].sizes = sizes
+
+        with self.lock:
+            for kind in self.roots:
+                storage_bytes.set(sum(document.sizes.get(kind, 0) for document in self.documents.values()), kind=kind)
+            storage_documents.set(len(self.documents))
+
+    def is_deleting(self, file_id: str) -> bool:
+        with self.lock:
+            return file_id in self.deleting
+
+    def delete(self, file_ids: List[str], reason: str, idle: float = 0.0) -> List[str]:
+        """
+        Forget documents everywhere, then delete their files, skipping those used within the last idle seconds.
+
+        Returns:
+            The file_ids of the deleted documents.
+        """
+        now = time.time()
+        with self.lock:
+            deleted = []
+            for file_id in file_ids:
+                document = self.documents.get(file_id)
+                if file_id in self.deleting or document is not None and now - document.last_access <= idle:
+                    continue
+                deleted.append(file_id)
+            # From here touch and document_dir refuse these documents, so the lock isn't needed to delete them
+            self.deleting.update(deleted)
+        if not deleted:
+            return []
+
+        try:
+            for callback in self.callbacks:
+                try:
+                    callback(deleted)
+                except Exception as e:
+                    logger.error(f"Failed to release {', '.join(deleted)} before deleting them: {e}")
+            for file_id in deleted:
+                for kind in self.roots:
+                    shutil.rmtree(self.path(kind, file_id), ignore_errors=True)
+        finally:
+            with self.lock:
+                for file_id in deleted:
+                    self.documents.pop(file_id, None)
+                    self.dirty.discard(file_id)
+                    self.deleting.discard(file_id)
+
+        storage_deleted.inc(len(deleted), reason=reason)
+        logger.info(f"Deleted stored files of {len(deleted)} documents ({reason}).")
+        return deleted
+
+    def sweep(self):
+        """Delete expired documents, then the least recently used ones while usage is above the quota."""
+        self.measure()
+        now = time.time()
+        with self.lock:
+            expired = [file_id for file_id, document in self.documents.items() if now - document.last_access > self.max_age]
+        self.delete(expired, "age", self.max_age)
+
+        usage = self.usage()
+        if usage <= self.quota:
+            return
+
+        target = self.quota * self.low_watermark
+        with self.lock:
+            candidates = sorted(
+                (document.last_access, file_id, document.size) for file_id, document in self.documents.items()
+                if now - document.last_access > self.grace
+            )
+        # Pick the least recently used documents that bring usage below the target and delete them together
+        victims = []
+        for _, file_id, size in candidates:
+            if usage <= target:
+                break
+            victims.append(file_id)
+            usage -= size
+        self.delete(victims, "quota", self.grace)
+
+        if self.usage() > self.quota:
+            logger.warning(f"Storage usage {self.usage()} is above the quota {self.quota} with only documents in use left.")
+        self.measure()
+
+    def ensure_space(self):
+        """Sweep when above the quota, raising StorageFull if that doesn't free enough."""
+        self.measure()
+        if self.usage() > self.quota:
+            self.sweep()
+            if self.usage() > self.quota:
+                raise StorageFull(f"Storage usage {self.usage()} is above the quota {self.quota}.")
+
+    def run(self, interval: float):
+        while not self.stop_event.wait(interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Storage sweep failed: {e}")
+
+    def start(self, interval: float = conf.sweep_interval):
+        """Start the background sweeper."""
+        if self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, args=(interval,), daemon=True, name="storage-sweeper")
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+storage = Storage(conf.roots, conf.max_age, conf.quota, conf.low_watermark, conf.grace)
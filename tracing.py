@@ -0,0 +1,69 @@
+# tracing.py
+import contextvars
+import os
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+# Layout pipeline tracing configuration
+class TraceConfig:
+    # Log every decision of the layout pipeline at DEBUG level, for every request
+    log: bool = os.environ.get("LAYOUT_TRACE", "0") == "1"
+    # Events kept per traced page, to bound memory on pathological pages
+    max_events: int = 100000
+
+conf = TraceConfig()
+
+class PageTrace:
+    """
+    Structured trace of the decisions taken while analysing one page.
+
+    Events are stored as (event, fields) and only formatted when logged, so recording them
+    costs a tuple per decision.
+    """
+
+    def __init__(self, log: bool = False, keep: bool = True):
+        self.events: List[Tuple[str, Dict]] = []
+        self.log = log
+        self.keep = keep
+
+    def __call__(self, event: str, **fields):
+        if self.log:
+            logger.opt(lazy=True).debug("{} {}", lambda: event, lambda: " ".join(f"{key}={value}" for key, value in fields.items()))
+        if self.keep and len(self.events) < conf.max_events:
+            self.events.append((event, fields))
+
+    def to_list(self) -> List[Dict]:
+        return [{"event": event, **fields} for event, fields in self.events]
+
+current_trace: contextvars.ContextVar[Optional[PageTrace]] = contextvars.ContextVar("current_trace", default=None)
+log_trace = PageTrace(log=True, keep=False)
+
+def get_tracer() -> Optional[PageTrace]:
+    """
+    Return the tracer of the current request, or None when tracing is off.
+
+    Hot loops call this once and guard each event with `if trace:`, so nothing is formatted
+    or allocated per iteration when tracing is off.
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        return trace
+    if conf.log:
+        return log_trace
+    return None
+
+@contextmanager
+def tracing(enabled: bool = True, log: bool = False):
+    """Record a PageTrace of the layout pipeline for the enclosed block when enabled."""
+    if not enabled:
+        yield None
+        return
+
+    trace = PageTrace(log=log)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
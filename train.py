@@ -11,6 +11,7 @@ def main(
     dropout: float = 0.0,
     seed: int = 0,
     resume: bool = False,
+    packed: bool = False,
 ):
     try:
         from clearml import Task
@@ -22,8 +23,16 @@ def main(
     except ImportError:
         print("clearml not installed")
 
+    trainer = None
+    if packed:
+        # datasets points at the data.yaml written by pack.py
+        from packed import PackedTrainer
+
+        trainer = PackedTrainer
+
     model = YOLO(base_model)
     results = model.train(
+        trainer=trainer,
         data=datasets,
         epochs=epochs,
         imgsz=imgsz,
@@ -1,64 +1,128 @@
 # upload.py
-from typing import List
+import threading
+from typing import List, Optional
 from pathlib import Path
 from uuid import uuid4
 
 from fastapi import UploadFile
 import shutil
+import cv2
+import numpy as np
 import pdfplumber
 
-from models import PDFPageData, TextRect
+from models import PDFPageData
+from metrics import pages_total, timer
+from extract import DocumentText
+import raster_cache
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
 
 
 DPI = 300  # Set the resolution (DPI) for rendering images from PDFs
+JPEG_QUALITY = 90  # Quality of the display JPEGs
+# "pdfium" renders straight into a BGR buffer, "pdfplumber" goes through pdfplumber's PageImage
+RENDER_BACKEND = "pdfium" if pdfium is not None else "pdfplumber"
+
+def render_with_pdfplumber(page: pdfplumber.page.Page, dpi: int) -> np.ndarray:
+    page_image = page.to_image(resolution=dpi)
+    return cv2.cvtColor(np.asarray(page_image.original.convert("RGB")), cv2.COLOR_RGB2BGR)
+
+def render_with_pdfium(document: "pdfium.PdfDocument", page_index: int, dpi: int) -> np.ndarray:
+    # pdfium renders BGR(A) by default, which is what cv2 and YOLO expect
+    bitmap = document[page_index].render(scale=dpi / 72)
+    image = bitmap.to_numpy()
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = image[:, :, :3]
+    return np.ascontiguousarray(image)
 
-def upload_pdf(file: UploadFile, upload_dir: Path, images_dir: Path, dpi: int = DPI) -> (str, List[PDFPageData], dict, dict):
-    file_id = str(uuid4())  # Generate a unique ID for this file
+def render_page(file_path: Path, page_number: int, dpi: int = DPI, backend: str = RENDER_BACKEND) -> np.ndarray:
+    """Render one page of a PDF into a BGR array."""
+    if backend == "pdfium":
+        document = pdfium.PdfDocument(str(file_path))
+        try:
+            return render_with_pdfium(document, page_number - 1, dpi)
+        finally:
+            document.close()
+
+    with pdfplumber.open(file_path) as pdf:
+        return render_with_pdfplumber(pdf.pages[page_number - 1], dpi)
+
+def save_page_image(image: np.ndarray, image_path: Path):
+    """Encode a rendered page as the JPEG shown by the UI, replacing any previous one atomically."""
+    ok, buffer = cv2.imencode(".jpeg", image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        raise ValueError(f"Failed to encode {image_path}")
+    # A reader never sees a partly written image, and its ETag always matches the content it gets
+    tmp_path = image_path.with_suffix(f".{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(buffer.tobytes())
+    tmp_path.replace(image_path)
+
+def upload_pdf(file: UploadFile, upload_dir: Path, images_dir: Path, dpi: int = DPI, render_images: bool = True, backend: str = RENDER_BACKEND, extract_text: bool = True, file_id: str = None) -> (str, List[PDFPageData], dict, dict):
+    """
+    Store an uploaded PDF and optionally render its pages and extract their text rects.
+
+    When render_images is False no page is rendered here; display JPEGs are then rendered on
+    first request and detection renders pages straight into arrays. Text rects are extracted
+    lazily per page; extract_text extracts every page on the worker pool while pages render
+    and includes them in the page data.
+    """
+    file_id = file_id or str(uuid4())  # Generate a unique ID for this file unless the caller picked one
     file_path = upload_dir / f"{file_id}.pdf"
     with open(file_path, "wb") as f:
         shutil.copyfileobj(file.file, f)
 
     page_data = []
-    text_rectangles_by_page = {file_id: {}}  # Store data by file_id first
     scaling_factors = {}
 
-    with pdfplumber.open(file_path) as pdf:
-        for page_number, page in enumerate(pdf.pages, start=1):
-            # Render the page as an image using pdfplumber with custom DPI
-            page_image = page.to_image(resolution=dpi)
-
-            # Save the rendered image
-            image_path = images_dir / f"{file_id}_page_{page_number}.jpeg"
-            page_image.save(image_path)
-
-            # Extract text rectangles from the page
-            text_rects = []
-            for char in page.chars:
-                text = char["text"]
-                if not text.strip() or not any(c.isprintable() for c in text):
-                    continue
-
-                rect = TextRect(
-                    box=[char["x0"], char["top"], char["x1"], char["bottom"]],
-                    text=text,
-                    fontname=char["fontname"],
-                    size=round(char["size"])
-                )
-                text_rects.append(rect)
-
-            text_rectangles_by_page[file_id][page_number] = text_rects  # Now stored by file_id and page_number
-
-            page_data.append(PDFPageData(
-                page_number=page_number,
-                image_url=f"/images/{file_id}_page_{page_number}.jpeg",
-                text_rects=text_rects
-            ))
-
-            # Calculate and store scaling factors
-            image_width = page_image.original.width
-            image_height = page_image.original.height
-            scale_x = image_width / page.width
-            scale_y = image_height / page.height
-            scaling_factors[(file_id, page_number)] = (scale_x, scale_y)
-
-    return file_id, page_data, text_rectangles_by_page, scaling_factors
+    document: Optional["pdfium.PdfDocument"] = None
+    if render_images and backend == "pdfium":
+        document = pdfium.PdfDocument(str(file_path))
+
+    try:
+        with pdfplumber.open(file_path) as pdf:
+            document_text = DocumentText(file_path, len(pdf.pages))
+            if extract_text:
+                document_text.prefetch()
+
+            for page_number, page in enumerate(pdf.pages, start=1):
+                # The page size in pixels follows from the DPI, whether or not the page is rendered now
+                image_width = round(page.width * dpi / 72)
+                image_height = round(page.height * dpi / 72)
+
+                if render_images:
+                    with timer("upload_render"):
+                        if document is not None:
+                            image = render_with_pdfium(document, page_number - 1, dpi)
+                        else:
+                            image = render_with_pdfplumber(page, dpi)
+                        image_height, image_width = image.shape[:2]
+
+                    # Keep the decoded page for detection, which then skips the JPEG round trip
+                    raster_cache.cache_page(file_id, page_number, image)
+
+                    with timer("upload_encode"):
+                        # Save the rendered image
+                        save_page_image(image, images_dir / f"{file_id}_page_{page_number}.jpeg")
+
+                page_data.append(PDFPageData(
+                    page_number=page_number,
+                    # Served through /get-image, which adds cache validators and smaller sizes
+                    image_url=f"/get-image/{file_id}/{page_number}",
+                    width=image_width,
+                    height=image_height,
+                    text_rects=document_text[page_number] if extract_text else []
+                ))
+
+                # Calculate and store scaling factors
+                scale_x = image_width / page.width
+                scale_y = image_height / page.height
+                scaling_factors[(file_id, page_number)] = (scale_x, scale_y)
+                pages_total.inc()
+    finally:
+        if document is not None:
+            document.close()
+
+    return file_id, page_data, {file_id: document_text}, scaling_factors